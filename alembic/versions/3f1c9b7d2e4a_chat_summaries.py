@@ -0,0 +1,32 @@
+"""Chat summaries
+
+Revision ID: 3f1c9b7d2e4a
+Revises: 99989526150b
+Create Date: 2026-10-17 10:12:41.318207+00:00
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9b7d2e4a'
+down_revision: Union[str, None] = '99989526150b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'chat_summaries',
+        sa.Column('session_id', sa.String(), nullable=False),
+        sa.Column('summary', sa.String(), nullable=False),
+        sa.Column('summarized_messages', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['session_id'], ['sessions.id'], ),
+        sa.PrimaryKeyConstraint('session_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('chat_summaries')
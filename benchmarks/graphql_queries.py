@@ -0,0 +1,92 @@
+"""
+Compares the time to build the services metrics query by rendering a Jinja template per service and metric and parsing
+the resulting document (as done before precompiled queries), with merging precompiled documents that get values from
+variables.
+
+Both approaches include printing the final document, as done by the transport when sending it.
+
+Run it with: poetry run python -m benchmarks.graphql_queries
+"""
+import asyncio
+import time
+from typing import Any, Dict, List
+
+from gql import gql
+from graphql import DocumentNode, print_ast
+from jinja2 import Template
+
+from skywalking_copilot.batching import QueryBatcher
+from skywalking_copilot.skywalking import Service, TimeRange, queries
+
+METRICS = {
+    "cpm": "avg(service_cpm)",
+    "sla": "avg(service_sla)/100",
+    "resp_time": "avg(service_resp_time)",
+    "apdex": "avg(service_apdex)/10000",
+}
+LEGACY_METRIC_TEMPLATE = Template("""{{ service.shortName }}_{{ metric_name }}: execExpression(\
+expression: "{{ expression }}", entity: {serviceName: "{{ service.name }}", normal: true}, \
+duration: {start: "{{ start }}", end: "{{ end }}", step: MINUTE}) {
+    results {
+        metric {
+            labels {
+                key value
+            }
+        }
+        values {
+            id value
+        }
+    }
+    error
+}""")
+SERVICES_COUNTS = [50, 200, 1000]
+REPETITIONS = 5
+
+
+def _build_services(count: int) -> List[Service]:
+    return [Service(id=f"service{i}", name=f"agent::service{i}", normal=True, shortName=f"service{i}",
+                    layers=["GENERAL"]) for i in range(count)]
+
+
+def _legacy_query(services: List[Service], time_range: TimeRange):
+    start = time_range.start.strftime("%Y-%m-%d %H%M")
+    end = time_range.end.strftime("%Y-%m-%d %H%M")
+    fields = [LEGACY_METRIC_TEMPLATE.render(service=service, metric_name=metric_name, expression=expression,
+                                            start=start, end=end)
+              for service in services for metric_name, expression in METRICS.items()]
+    print_ast(gql(f"query queryMetrics {{\n{'\n'.join(fields)}\n}}"))
+
+
+async def _print_document(document: DocumentNode, variables: Dict[str, Any]) -> dict:
+    print_ast(document)
+    return {}
+
+
+async def _precompiled_query(services: List[Service], time_range: TimeRange, batcher: QueryBatcher):
+    duration = time_range.to_gql_variable()
+    await asyncio.gather(*[
+        batcher.query(queries["service-metric"],
+                      {"expression": expression, "entity": service.to_gql_variable(), "duration": duration})
+        for service in services for expression in METRICS.values()])
+
+
+def _measure(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        fn()
+    return (time.perf_counter() - start) / REPETITIONS * 1000
+
+
+def main():
+    time_range = TimeRange.from_last_minutes(10)
+    print(f"{'services':>10} {'legacy (ms)':>12} {'precompiled (ms)':>17}")
+    for count in SERVICES_COUNTS:
+        services = _build_services(count)
+        legacy = _measure(lambda: _legacy_query(services, time_range))
+        batcher = QueryBatcher(_print_document, max_fields=count * len(METRICS))
+        precompiled = _measure(lambda: asyncio.run(_precompiled_query(services, time_range, batcher)))
+        print(f"{count:>10} {legacy:>12.2f} {precompiled:>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares the time to parse and align metric series for a chart creating a model per point and walking each series
+point by point (as done before numpy alignment, without the early return which only kept the first series), with
+parsing them into numpy arrays and aligning them as such.
+
+Series have 10% of points missing, so they need to be aligned to the union of timestamps.
+
+Run it with: poetry run python -m benchmarks.metric_chart
+"""
+import random
+import time
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from skywalking_copilot.series import align_series, metric_to_arrays, to_json_values
+from skywalking_copilot.skywalking import ServiceMetric
+
+SERIES_COUNT = 5
+POINTS_COUNTS = [100, 1_000, 10_000]
+REPETITIONS = 5
+
+
+class _LegacyMetricValue(BaseModel):
+    id: Optional[str]
+    value: Optional[str]
+
+
+def _build_series(points_count: int) -> List[dict]:
+    rnd = random.Random(0)
+    return [{"metric": {"labels": [{"key": "p", "value": str(idx)}]}, "values": [
+        {"id": str(1_700_000_000_000 + point * 60_000), "value": str(rnd.uniform(0, 1000))}
+        for point in range(points_count) if rnd.random() > 0.1]} for idx in range(SERIES_COUNT)]
+
+
+def _legacy_align(data: List[dict]) -> Tuple[List[int], List[List[Optional[float]]]]:
+    metrics = [[_LegacyMetricValue(**value) for value in metric['values']] for metric in data]
+    x_vals = sorted(set([int(value.id) for values in metrics for value in values]))
+    ret = []
+    for values in metrics:
+        vals_idx = 0
+        y_vals = []
+        for x_val in x_vals:
+            point = values[vals_idx] if vals_idx < len(values) else None
+            if point and x_val == int(point.id):
+                y_vals.append(float(point.value) if point.value else None)
+                vals_idx += 1
+            else:
+                y_vals.append(None)
+        ret.append(y_vals)
+    return x_vals, ret
+
+
+def _numpy_align(data: List[dict]) -> Tuple[List[int], List[List[Optional[float]]]]:
+    metrics = [ServiceMetric.from_gql(metric) for metric in data]
+    x_vals, y_vals = align_series([metric_to_arrays(metric) for metric in metrics])
+    return x_vals.tolist(), [to_json_values(metric_y_vals) for metric_y_vals in y_vals]
+
+
+def _measure(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        fn()
+    return (time.perf_counter() - start) / REPETITIONS * 1000
+
+
+def main():
+    print(f"{'series':>7} {'points':>7} {'legacy (ms)':>12} {'numpy (ms)':>11}")
+    for points_count in POINTS_COUNTS:
+        data = _build_series(points_count)
+        assert _legacy_align(data) == _numpy_align(data)
+        legacy = _measure(lambda: _legacy_align(data))
+        vectorized = _measure(lambda: _numpy_align(data))
+        print(f"{SERIES_COUNT:>7} {points_count:>7} {legacy:>12.2f} {vectorized:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares the throughput of rendering responses looking up templates on each render with default environment settings
+(as done before, which checks template files for changes on each lookup), with rendering the preloaded templates.
+
+GraphQL queries are no longer templates (they are parsed once and receive variables), so the services metrics table
+rows and the service metric chart are measured, being the most frequently rendered responses.
+
+Run it with: poetry run python -m benchmarks.templates
+"""
+import json
+import time
+from typing import Any, Callable, Dict
+
+from jinja2 import Environment, FileSystemLoader
+
+from skywalking_copilot.skywalking import ServiceSummaryMetrics
+from skywalking_copilot.templates import assets_path, solve_response, solve_response_macro
+
+RENDERS = 10_000
+SERVICES_COUNT = 10
+CHART_POINTS = 200
+
+legacy_repo = Environment(loader=FileSystemLoader(assets_path))
+legacy_repo.filters['json'] = json.dumps
+
+
+def _legacy_solve_response(name: str, ctx: Dict[str, Any]) -> str:
+    return legacy_repo.get_template(f"responses/{name}.md").render(**ctx)
+
+
+def _legacy_solve_response_macro(name: str, macro: str, *args: Any) -> str:
+    return getattr(legacy_repo.get_template(f"responses/{name}.md").module, macro)(*args)
+
+
+def _measure(fn: Callable[[], str]) -> float:
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        fn()
+    return RENDERS / (time.perf_counter() - start)
+
+
+def main():
+    service_metrics = {f"service{idx}": ServiceSummaryMetrics(cpm=idx * 10, sla=99.5, resp_time=idx * 3, apdex=0.98)
+                       for idx in range(SERVICES_COUNT)}
+    chart_ctx = {"title": "Load (calls/min)", "unit": "calls/min", "x_vals": list(range(CHART_POINTS)),
+                 "x_format": "HH:mm", "legends": [], "series": [{"data": [1.5] * CHART_POINTS}],
+                 "sw_url": "http://localhost:8080"}
+    cases = {
+        "services-metrics rows": (
+            lambda: _legacy_solve_response_macro("services-metrics", "rows", service_metrics),
+            lambda: solve_response_macro("services-metrics", "rows", service_metrics)),
+        "service-metric-chart": (
+            lambda: _legacy_solve_response("service-metric-chart", chart_ctx),
+            lambda: solve_response("service-metric-chart", chart_ctx)),
+    }
+    print(f"{'template':<22} {'legacy (renders/s)':>19} {'preloaded (renders/s)':>22}")
+    for name, (legacy, preloaded) in cases.items():
+        assert legacy() == preloaded()
+        print(f"{name:<22} {_measure(legacy):>19.0f} {_measure(preloaded):>22.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Compares the time to build and flatten traces spans trees with pydantic spans and recursive traversals (as done
+before compact spans), with slotted spans and iterative traversals, for synthetic traces of different sizes.
+
+Wide traces have segments with three exit spans each, and deep traces have one exit span per segment, nesting
+segments beyond the default recursion limit.
+
+Run it with: poetry run python -m benchmarks.traces
+"""
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from skywalking_copilot.skywalking import TraceSpan, TraceSpanType, build_spans_tree
+from skywalking_copilot.traces import build_spans_context
+
+TRACES = [("wide", 1_000, 3), ("wide", 10_000, 3), ("wide", 100_000, 3), ("deep", 4_000, 1)]
+REPETITIONS = 3
+
+
+class LegacyTraceSpan(BaseModel):
+    trace_id: str
+    segment_id: str
+    span_id: int
+    parent_segment_id: Optional[str]
+    parent_span_id: Optional[int]
+    ref_trace_id: Optional[str]
+    service: str
+    start_time: int
+    end_time: int
+    endpoint: str
+    type: TraceSpanType
+    peer: str
+    component: str
+    is_error: bool
+    layer: str
+    tags: Dict[str, str]
+    children: List['LegacyTraceSpan']
+
+    @staticmethod
+    def from_gql(data: dict) -> 'LegacyTraceSpan':
+        refs = data['refs']
+        ref = refs[0] if refs else None
+        return LegacyTraceSpan(
+            trace_id=data['traceId'],
+            segment_id=data['segmentId'], span_id=data['spanId'],
+            parent_segment_id=ref['parentSegmentId'] if ref else None,
+            parent_span_id=ref['parentSpanId'] if ref else None,
+            ref_trace_id=ref['traceId'] if ref else None,
+            service=data['serviceCode'], start_time=int(data['startTime']), end_time=int(data['endTime']),
+            endpoint=data['endpointName'], type=TraceSpanType(data['type']), peer=data['peer'],
+            component=data['component'], is_error=data['isError'], layer=data['layer'],
+            tags={t['key']: t['value'] for t in data['tags']}, children=[])
+
+
+def _legacy_build_spans_tree(spans: List[dict]) -> List[LegacyTraceSpan]:
+    spans_by_id = {}
+    segments_parents = {}
+    root_spans = []
+    for span in spans:
+        span = LegacyTraceSpan.from_gql(span)
+        spans_by_id[f"{span.segment_id}-{span.span_id}"] = span
+        segment_parent = segments_parents.get(span.segment_id)
+        if not segment_parent and span.parent_segment_id:
+            segment_parent = spans_by_id.get(f"{span.parent_segment_id}-{span.parent_span_id}")
+            if segment_parent:
+                segments_parents[span.segment_id] = segment_parent
+        if segment_parent:
+            segment_parent.children.append(span)
+        else:
+            root_spans.append(span)
+    for span in root_spans:
+        _legacy_simplify_span(span)
+    return root_spans
+
+
+def _legacy_simplify_span(span: LegacyTraceSpan):
+    final_children = []
+    for child in span.children:
+        _legacy_simplify_span(child)
+        if child.type in [TraceSpanType.LOCAL, TraceSpanType.ENTRY]:
+            final_children += child.children
+        else:
+            final_children.append(child)
+    span.children = final_children
+
+
+def _legacy_build_spans_context(spans: List[LegacyTraceSpan], prefix: str = "") -> List[Dict]:
+    ret = []
+    for idx, span in enumerate(spans):
+        ret.append({
+            'prefix': prefix + ("└─ " if idx == len(spans) - 1 else "├─ "),
+            'name': f"@{span.peer} {span.tags.get('db.statement') or span.endpoint}",
+            'duration': span.end_time - span.start_time
+        })
+        ret += _legacy_build_spans_context(span.children, prefix + ("    " if idx == len(spans) - 1 else "│   "))
+    return ret
+
+
+def _build_trace(spans_count: int, fan_out: int) -> List[dict]:
+    ret = []
+    pending_segments: deque[Tuple[Optional[str], Optional[int]]] = deque([(None, None)])
+    while pending_segments and len(ret) < spans_count:
+        parent_segment_id, parent_span_id = pending_segments.popleft()
+        segment_id = f"segment{len(ret)}"
+        ret.append(_build_span(segment_id, 0, TraceSpanType.ENTRY, len(ret), parent_segment_id, parent_span_id))
+        for span_id in range(1, fan_out + 1):
+            ret.append(_build_span(segment_id, span_id, TraceSpanType.EXIT, len(ret)))
+            pending_segments.append((segment_id, span_id))
+    return ret[:spans_count]
+
+
+def _build_span(segment_id: str, span_id: int, span_type: TraceSpanType, start: int,
+                parent_segment_id: Optional[str] = None, parent_span_id: Optional[int] = None) -> dict:
+    return {
+        "traceId": "trace", "segmentId": segment_id, "spanId": span_id,
+        "refs": [{"traceId": "trace", "parentSegmentId": parent_segment_id, "parentSpanId": parent_span_id}]
+        if parent_segment_id else [],
+        "serviceCode": "service", "startTime": start, "endTime": start + 10, "endpointName": f"endpoint{span_id}",
+        "type": span_type.value, "peer": "db:5432", "component": "PostgreSQL", "isError": False, "layer": "Database",
+        "tags": [{"key": "db.statement", "value": "SELECT 1"}],
+    }
+
+
+def _legacy(spans: List[dict]):
+    _legacy_build_spans_context(_legacy_build_spans_tree(spans))
+
+
+def _compact(spans: List[dict]):
+    build_spans_context(build_spans_tree([TraceSpan.from_gql(span) for span in spans]))
+
+
+def _measure(fn) -> str:
+    start = time.perf_counter()
+    try:
+        for _ in range(REPETITIONS):
+            fn()
+    except RecursionError:
+        return "recursion error"
+    return f"{(time.perf_counter() - start) / REPETITIONS * 1000:.2f}"
+
+
+def main():
+    print(f"{'trace':>6} {'spans':>8} {'legacy (ms)':>16} {'compact (ms)':>13}")
+    for shape, spans_count, fan_out in TRACES:
+        spans = _build_trace(spans_count, fan_out)
+        legacy = _measure(lambda: _legacy(spans))
+        compact = _measure(lambda: _compact(spans))
+        print(f"{shape:>6} {spans_count:>8} {legacy:>16} {compact:>13}")
+
+
+if __name__ == "__main__":
+    main()
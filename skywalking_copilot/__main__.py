@@ -1,3 +1,4 @@
+import os
 import sys
 
 import dotenv
@@ -11,4 +12,6 @@ if __name__ == "__main__":
     LOGGING_CONFIG["formatters"]["access"]["fmt"] = "%(asctime)s [%(name)s] %(levelprefix)s %(client_addr)s - \"%(request_line)s\" %(status_code)s"
     LOGGING_CONFIG["loggers"]["skywalking_copilot"] = {"handlers": ["default"], "level": "INFO"}
     LOGGING_CONFIG["loggers"]["openai"] = {"handlers": ["default"], "level": "DEBUG"}
-    uvicorn.run("skywalking_copilot.api:app", host="0.0.0.0", port=8000, reload=len(sys.argv) > 1)
+    # multiple workers should be used with a shared cache (CACHE_URL), and are ignored when reloading
+    uvicorn.run("skywalking_copilot.api:app", host="0.0.0.0", port=8000, reload=len(sys.argv) > 1,
+                workers=int(os.getenv("WORKERS", 1)))
@@ -1,101 +1,311 @@
 import asyncio
+import json
 import logging
 import os
-from typing import List, AsyncIterator, Dict, Optional, Any
+import re
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import List, AsyncIterator, Dict, Optional, Any, Tuple, Union, Callable, Awaitable
 from uuid import UUID
 
 from langchain.agents import AgentExecutor, create_openai_functions_agent
-from langchain.callbacks import AsyncIteratorCallbackHandler
 from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
 from langchain.prompts import MessagesPlaceholder, ChatPromptTemplate, HumanMessagePromptTemplate
 from langchain.schema import SystemMessage
 from langchain.tools import BaseTool
+from langchain_core.agents import AgentAction
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
 from langchain_core.messages import BaseMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_openai import AzureChatOpenAI
 from langchain_openai.chat_models.base import BaseChatOpenAI
-from langchain_postgres import PostgresChatMessageHistory
-from psycopg import AsyncConnection
 
-from skywalking_copilot.agent_tools import ServicesMetricsTool, ServicesTopologyTool, ServiceMetricChartTool
-from skywalking_copilot.database import CHAT_HISTORY_TABLE
+from skywalking_copilot.agent_tools import ServicesMetricsTool, ServicesTopologyTool, ServiceMetricChartTool, \
+    ServicesTopologyChangesTool, TOOL_OUTPUT_EVENT, ToolResultsCache
+from skywalking_copilot.caching import LruCache, CacheBackend
+from skywalking_copilot.database import CHAT_HISTORY_TABLE, history_pool, chat_messages_writes
 from skywalking_copilot.domain import Session
+from skywalking_copilot.memory import WindowSummaryMemory, PooledChatMessageHistory, chat_summaries
+from skywalking_copilot.metrics import metrics
 from skywalking_copilot.skywalking import SkywalkingApi
 
 
-class Agent:
+logger = logging.getLogger(__name__)
+assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets')
+MEMORY_KEY = "chat_history"
 
-    def __init__(self, session: Session, db: AsyncConnection, sw_api: SkywalkingApi):
-        self._session = session
+
+class AgentFactory:
+    """
+    Builds the parts of an agent which are shared among sessions (llm client, tools, prompt and agent runnable) only
+    once, and attaches to them the memory of each session when creating an agent.
+    """
+
+    def __init__(self, sw_api: SkywalkingApi, cache: CacheBackend):
         self._llm = self._build_llm()
-        self._memory = self._build_memory(session.id, db)
-        tools: List[BaseTool] = [
-            ServicesMetricsTool(sw_api=sw_api),
-            ServicesTopologyTool(sw_api=sw_api),
-            ServiceMetricChartTool(sw_api=sw_api),
+        results_cache = ToolResultsCache(int(os.getenv("TOOLS_CACHE_SIZE", 100)), cache)
+        self._tools: List[BaseTool] = [
+            ServicesMetricsTool(sw_api=sw_api, results_cache=results_cache),
+            ServicesTopologyTool(sw_api=sw_api, results_cache=results_cache,
+                                 max_nodes=int(os.getenv("TOPOLOGY_MAX_NODES", 50))),
+            ServicesTopologyChangesTool(sw_api=sw_api, results_cache=results_cache),
+            # downsampling keeps at least the first and last points of a chart
+            ServiceMetricChartTool(sw_api=sw_api, results_cache=results_cache,
+                                   chart_max_points=max(int(os.getenv("CHART_MAX_POINTS", 200)), 2)),
         ]
-        self._agent = self._build_agent(self._llm, self._memory, tools)
+        self._agent = create_openai_functions_agent(llm=self._llm, tools=self._tools, prompt=self._build_prompt())
+        self._max_iterations = int(os.getenv("AGENT_MAX_ITERATIONS", 3))
+        self._memory_mode = os.getenv("AGENT_MEMORY_MODE", "buffer")
+        self._memory_window_turns = int(os.getenv("AGENT_MEMORY_WINDOW_TURNS", 3))
+        self._stream_queue_size = int(os.getenv("AGENT_STREAM_QUEUE_SIZE", 100))
+        self._routes: LruCache[Tuple[str, str], ToolRoute] = LruCache(
+            int(os.getenv("AGENT_ROUTES_CACHE_SIZE", 1000)), float(os.getenv("AGENT_ROUTES_CACHE_TTL_SECONDS", 3600)))
 
     @staticmethod
-    def _build_llm():
+    def _build_llm() -> BaseChatOpenAI:
         return AzureChatOpenAI(azure_endpoint=os.getenv("AZURE_ENDPOINT"),
                                deployment_name=os.getenv("AZURE_DEPLOYMENT_NAME"),
                                model_name=os.getenv("MODEL_NAME"), temperature=0, verbose=True, streaming=True)
 
-    @staticmethod
-    def _build_memory(session_id: UUID, db: AsyncConnection) -> ConversationBufferMemory:
-        message_history = PostgresChatMessageHistory(CHAT_HISTORY_TABLE, str(session_id), async_connection=db)
-        return ConversationBufferMemory(memory_key="chat_history", chat_memory=message_history, return_messages=True)
-
-    def _build_agent(
-            self, llm: BaseChatOpenAI, memory: ConversationBufferMemory, tools: List[BaseTool]) -> AgentExecutor:
-        prompt = ChatPromptTemplate(messages=[
+    def _build_prompt(self) -> ChatPromptTemplate:
+        return ChatPromptTemplate(messages=[
             SystemMessage(content=self._read_file("system-prompt.md")),
-            MessagesPlaceholder(variable_name=memory.memory_key),
+            MessagesPlaceholder(variable_name=MEMORY_KEY),
             HumanMessagePromptTemplate.from_template("{input}"),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ])
-        agent = create_openai_functions_agent(llm=llm, tools=tools, prompt=prompt)
-        return AgentExecutor(
-            agent=agent,
-            tools=tools,
+
+    @staticmethod
+    def _read_file(path: str) -> str:
+        with open(os.path.join(assets_path, path), encoding="utf-8") as f:
+            return f.read()
+
+    def create(self, session: Session) -> 'Agent':
+        memory = self._build_memory(session.id)
+        executor = AgentExecutor(
+            agent=self._agent,
+            tools=self._tools,
             memory=memory,
             verbose=True,
             return_intermediate_steps=False,
-            max_iterations=os.getenv("AGENT_MAX_ITERATIONS", 3)
+            max_iterations=self._max_iterations
         )
+        return Agent(session, memory, executor, self._llm, self._tools, self._routes, self._stream_queue_size)
 
-    @staticmethod
-    def _read_file(path: str) -> str:
-        with open(os.path.join('skywalking_copilot', 'assets', path), encoding="utf-8") as f:
-            return f.read()
+    def _build_memory(self, session_id: UUID) -> BaseChatMemory:
+        message_history = PooledChatMessageHistory(history_pool, chat_messages_writes, CHAT_HISTORY_TABLE,
+                                                   str(session_id))
+        if self._memory_mode == "window":
+            return WindowSummaryMemory(memory_key=MEMORY_KEY, chat_memory=message_history, llm=self._llm,
+                                       pool=history_pool, writes=chat_messages_writes, summaries=chat_summaries,
+                                       session_id=str(session_id), window_turns=self._memory_window_turns)
+        return ConversationBufferMemory(memory_key=MEMORY_KEY, chat_memory=message_history, return_messages=True)
+
+
+@dataclass
+class ToolRoute:
+    tool: str
+    tool_input: Union[str, Dict[str, Any]]
+    routing_ms: float
+
+
+class AnswerEventType(Enum):
+    TOKEN = "token"
+    TOOL_START = "tool_start"
+    TOOL_END = "tool_end"
+    FINAL = "final"
+
+
+@dataclass
+class AnswerEvent:
+    type: AnswerEventType
+    data: str = ""
+
+
+class Agent:
+    """
+    Answers questions of a session, streaming generated tokens, tools outputs and tools runs progress as answer events.
+
+    Tools chosen by the llm for a question are kept in a cache shared among sessions, by normalized question and
+    locale, so the same question is later answered by directly running the tool, skipping the llm round trip.
+    Only questions whose tool arguments are all contained in the question are cached, since other arguments may
+    depend on previous messages of the conversation.
+    """
+
+    def __init__(self, session: Session, memory: BaseChatMemory, agent: AgentExecutor, llm: BaseChatOpenAI,
+                 tools: List[BaseTool], routes: LruCache[Tuple[str, str], ToolRoute], stream_queue_size: int = 100):
+        self._session = session
+        self._memory = memory
+        self._agent = agent
+        self._llm = llm
+        self._tools = {tool.name: tool for tool in tools}
+        self._routes = routes
+        self._stream_queue_size = stream_queue_size
 
     async def start_session(self):
         await self._memory.chat_memory.aadd_messages(
             [HumanMessage(content="this is my locale: " + self._session.locales[0])])
 
-    async def ask(self, question: str) -> AsyncIterator[str]:
-        callback = FullAsyncIteratorCallbackHandler()
-        task = asyncio.create_task(
-            self._agent.ainvoke({"input": question},
-                                RunnableConfig(callbacks=[callback])))
-        resp = ""
-        async for token in callback.aiter():
-            resp += token
-            yield token
-        ret = await task
-        answer = ret['output']
-        # when using tools, tokens are not passed to the callback handler, so we need to get the
-        # response directly from agent run call
-        if answer != resp:
-            yield answer
-
-
-# avoid warning due to unimplemented methods
-class FullAsyncIteratorCallbackHandler(AsyncIteratorCallbackHandler):
+    async def ask(self, question: str) -> AsyncIterator[AnswerEvent]:
+        normalized_question = _normalize_question(question)
+        route_key = (normalized_question, self._session.locales[0])
+        route = self._routes.get(route_key)
+        if route:
+            metrics.increment("agent.routes_cache.hits")
+            metrics.observe("agent.routes_cache.saved_ms", route.routing_ms)
+            async for event in self._stream_answer(lambda callbacks: self._run_tool(question, route, callbacks)):
+                yield event
+            return
+        metrics.increment("agent.routes_cache.misses")
+        routing = RoutingCallbackHandler()
+        agent_callbacks = [routing, PromptTokensCallbackHandler(self._llm)]
+        async for event in self._stream_answer(lambda handlers: self._run_agent(question, handlers + agent_callbacks)):
+            yield event
+        if len(routing.routes) == 1 and self._is_cacheable(routing.routes[0], normalized_question):
+            self._routes.set(route_key, routing.routes[0])
+
+    async def _stream_answer(self, run: Callable[[List[BaseCallbackHandler]], Awaitable[str]]) \
+            -> AsyncIterator[AnswerEvent]:
+        callback = AnswerStreamCallbackHandler(self._stream_queue_size)
+        task = asyncio.create_task(run([callback]))
+        task.add_done_callback(lambda _: callback.done.set())
+        tokens = []
+        try:
+            async for event in callback.aiter():
+                if event.type == AnswerEventType.TOKEN:
+                    tokens.append(event.data)
+                yield event
+            answer = await task
+        finally:
+            # when the client disconnects the stream is cancelled (or closed), so the run is cancelled to stop
+            # consuming llm tokens, Skywalking queries and database connections for an answer nobody will get
+            if not task.done():
+                task.cancel()
+                metrics.increment("agent.cancelled_answers")
+        # when using tools which don't stream their output, tokens are not passed to the callback handler, so we need to
+        # get the response directly from agent run call
+        if answer != "".join(tokens):
+            yield AnswerEvent(AnswerEventType.TOKEN, answer)
+        yield AnswerEvent(AnswerEventType.FINAL)
+
+    async def _run_agent(self, question: str, callbacks: List[BaseCallbackHandler]) -> str:
+        ret = await self._agent.ainvoke({"input": question}, RunnableConfig(callbacks=callbacks))
+        return ret['output']
+
+    async def _run_tool(self, question: str, route: ToolRoute, callbacks: List[BaseCallbackHandler]) -> str:
+        ret = await self._tools[route.tool].ainvoke(route.tool_input, RunnableConfig(callbacks=callbacks))
+        await self._memory.asave_context({"input": question}, {"output": ret})
+        return ret
+
+    def _is_cacheable(self, route: ToolRoute, normalized_question: str) -> bool:
+        tool = self._tools.get(route.tool)
+        if not tool or not tool.return_direct:
+            return False
+        if not isinstance(route.tool_input, dict):
+            return _normalize_question(str(route.tool_input)) in normalized_question
+        # arguments with default values (eg: default time window) don't depend on the question nor the conversation
+        fields = tool.args_schema.model_fields if tool.args_schema else {}
+        args = [value for name, value in route.tool_input.items()
+                if name not in fields or fields[name].is_required() or value != fields[name].default]
+        return all(_normalize_question(str(arg)) in normalized_question for arg in args)
+
+
+def _normalize_question(question: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+class RoutingCallbackHandler(AsyncCallbackHandler):
+    """Records the tools chosen by the llm, with the time it took to choose each one since the run started."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.routes: List[ToolRoute] = []
+
+    async def on_agent_action(
+            self, action: AgentAction, *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+            tags: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self.routes.append(ToolRoute(action.tool, action.tool_input, (time.perf_counter() - self._start) * 1000))
+
+
+class AnswerStreamCallbackHandler(AsyncCallbackHandler):
+    """
+    Provides tokens generated by the llm, partial outputs streamed by tools, and start and end of tools runs, as answer
+    events.
+
+    Events are kept in a bounded queue, and handlers wait for room in it, so a slow client slows down the run instead of
+    accumulating events in memory. Since tools run after the llm ends, iteration only ends when done is explicitly set.
+    """
+
+    def __init__(self, max_size: int):
+        self.queue: asyncio.Queue[AnswerEvent] = asyncio.Queue(max_size)
+        self.done = asyncio.Event()
+        self._tools: Dict[UUID, str] = {}
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # function calls chosen by the llm are streamed as empty tokens
+        if token:
+            await self._put(AnswerEvent(AnswerEventType.TOKEN, token))
+
+    async def on_custom_event(
+            self, name: str, data: Any, *, run_id: UUID, tags: Optional[List[str]] = None,
+            metadata: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+        if name == TOOL_OUTPUT_EVENT:
+            await self._put(AnswerEvent(AnswerEventType.TOKEN, data))
+
+    async def on_tool_start(
+            self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+            tags: Optional[List[str]] = None, metadata: Optional[Dict[str, Any]] = None,
+            inputs: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+        tool = serialized.get("name", "")
+        self._tools[run_id] = tool
+        tool_input = inputs if inputs is not None else input_str
+        await self._put(AnswerEvent(AnswerEventType.TOOL_START, json.dumps({"tool": tool, "input": tool_input},
+                                                                           default=str)))
+
+    async def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        await self._put(AnswerEvent(AnswerEventType.TOOL_END, json.dumps({"tool": self._tools.pop(run_id, "")})))
+
+    async def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        await self._put(AnswerEvent(AnswerEventType.TOOL_END, json.dumps({"tool": self._tools.pop(run_id, ""),
+                                                                         "error": True})))
+
+    async def _put(self, event: AnswerEvent):
+        if self.queue.full():
+            metrics.increment("agent.stream_queue_full")
+        await self.queue.put(event)
+
+    async def aiter(self) -> AsyncIterator[AnswerEvent]:
+        while True:
+            event = asyncio.ensure_future(self.queue.get())
+            done = asyncio.ensure_future(self.done.wait())
+            try:
+                await asyncio.wait([event, done], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # pending waits are also cancelled when the iteration is cancelled, to avoid leaking them
+                done.cancel()
+                received = event.done()
+                if not received:
+                    event.cancel()
+            if not received:
+                break
+            yield event.result()
+        while not self.queue.empty():
+            yield self.queue.get_nowait()
+
+
+class PromptTokensCallbackHandler(AsyncCallbackHandler):
+    """Records the number of tokens sent to the llm on each call, which is mostly driven by the chat history size."""
+
+    def __init__(self, llm: BaseChatOpenAI):
+        self._llm = llm
 
     async def on_chat_model_start(
             self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *, run_id: UUID,
             parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None,
             metadata: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Any:
-        pass
+        for prompt in messages:
+            tokens = self._llm.get_num_tokens_from_messages(prompt)
+            logger.info(f"Sending {tokens} prompt tokens to llm")
+            metrics.observe("agent.prompt_tokens", tokens)
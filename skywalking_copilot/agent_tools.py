@@ -1,61 +1,238 @@
-import re
+import asyncio
+import datetime
 from enum import Enum
-from typing import Optional, List, Type
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, Type
 
 from langchain.tools import BaseTool
+from langchain_core.callbacks import AsyncCallbackManagerForToolRun, adispatch_custom_event
 from pydantic import BaseModel, Field
 
-from skywalking_copilot.skywalking import SkywalkingApi, TimeRange, Topology, ServiceMetric
-from skywalking_copilot.templates import solve_response
+from skywalking_copilot.caching import LruCache, SingleFlight, CacheBackend
+from skywalking_copilot.metrics import metrics
+from skywalking_copilot.series import align_series, metric_to_arrays, to_json_values, downsample
+from skywalking_copilot.skywalking import SkywalkingApi, TimeRange, ServiceMetric, DurationStep
+from skywalking_copilot.templates import solve_response, solve_response_macro
+from skywalking_copilot.topology import TopologyGraph
+
+TOOL_OUTPUT_EVENT = "tool_output"
+
+
+class PartialOutputs:
+    """
+    Partial outputs of a tool run, which each caller waiting for the run streams at its own pace, so a slow (or gone)
+    caller never blocks the run nor other callers.
+    """
+
+    def __init__(self):
+        self._outputs: List[str] = []
+        self._changed = asyncio.Event()
+
+    def add(self, output: str) -> str:
+        self._outputs.append(output)
+        # waiters of the previous event are woken up, and later waits use a new one
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+        return output
+
+    async def stream_until(self, run: asyncio.Future, stream: Callable[[str], Awaitable[Any]]):
+        """Streams partial outputs, including the ones added before this call, until the given run completes."""
+        streamed = 0
+        while True:
+            changed = self._changed
+            # checked before streaming, so outputs added right before the run completes are also streamed
+            finished = run.done()
+            while streamed < len(self._outputs):
+                await stream(self._outputs[streamed])
+                streamed += 1
+            if finished:
+                return
+            waiter = asyncio.ensure_future(changed.wait())
+            try:
+                await asyncio.wait([waiter, run], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+
+
+ToolSolver = Callable[[Callable[[str], str]], Awaitable[str]]
+
+
+class ToolResultsCache:
+    """
+    Process wide cache of tools results, keyed by tool, arguments and minute of the queried time range, since tools
+    results only change from one minute to the next. Results are also stored in the given cache backend, to share
+    them with other workers.
+
+    Concurrent runs of a tool with same key are coalesced into one, so only one of them queries Skywalking. Partial
+    outputs of the coalesced run are streamed to each caller independently.
+    """
+    # results are kept a bit longer than their minute, since time ranges of workers may not be exactly aligned
+    RESULTS_TTL = 120
+
+    def __init__(self, max_size: int, backend: CacheBackend):
+        self._results: LruCache[Tuple[str, Hashable, datetime.datetime], str] = LruCache(max_size, self.RESULTS_TTL)
+        self._backend = backend
+        self._flight = SingleFlight()
+        self._partial_outputs: Dict[Tuple[str, Hashable, datetime.datetime], PartialOutputs] = {}
+
+    async def get_or_solve(self, tool: str, args: Hashable, time_range: TimeRange, solve: ToolSolver,
+                           stream: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+        key = (tool, args, time_range.end.replace(second=0, microsecond=0))
+        ret = self._results.get(key)
+        if ret is not None:
+            metrics.increment("tools_cache.hits")
+            return ret
+        partial_outputs = self._partial_outputs.setdefault(key, PartialOutputs())
+        # solve_and_cache only runs for the caller starting the run, so other callers keep the coalesced outcome
+        outcome = "coalesced"
+
+        async def solve_and_cache() -> str:
+            nonlocal outcome
+            try:
+                backend_key = f"tools:{tool}:{args!r}:{key[2]:%Y%m%d%H%M}"
+                result = await self._backend.get(backend_key)
+                if result is None:
+                    outcome = "misses"
+                    result = await solve(partial_outputs.add)
+                    await self._backend.set(backend_key, result, self.RESULTS_TTL)
+                else:
+                    outcome = "shared_hits"
+                self._results.set(key, result)
+                return result
+            finally:
+                if self._partial_outputs.get(key) is partial_outputs:
+                    del self._partial_outputs[key]
+
+        ret = await _run_streaming(self._flight.run(key, solve_and_cache), partial_outputs, stream)
+        metrics.increment(f"tools_cache.{outcome}")
+        return ret
+
+
+async def _run_streaming(run: Awaitable[str], partial_outputs: PartialOutputs,
+                         stream: Optional[Callable[[str], Awaitable[Any]]]) -> str:
+    if not stream:
+        return await run
+    run = asyncio.ensure_future(run)
+    try:
+        await partial_outputs.stream_until(run, stream)
+        return await run
+    finally:
+        run.cancel()
 
 
 class AgentTool(BaseTool):
     sw_api: SkywalkingApi
+    results_cache: Optional[ToolResultsCache] = None
     return_direct = True
 
     def _run(self, *args, **kwargs):
         raise NotImplementedError()
 
+    async def _solve_cached(self, args: Hashable, time_range: TimeRange, solve: ToolSolver,
+                            run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
+        """
+        Solves the tool output with the given function, or gets it from the results cache if available.
+
+        The function gets a callback to provide partial outputs, which are streamed to the given run manager. Outputs
+        got from the cache are not streamed, and are only provided as the tool result.
+        """
+        stream = (lambda output: self._stream_output(output, run_manager)) if run_manager else None
+        if not self.results_cache:
+            partial_outputs = PartialOutputs()
+            return await _run_streaming(solve(partial_outputs.add), partial_outputs, stream)
+        return await self.results_cache.get_or_solve(self.name, args, time_range, solve, stream)
+
+    @staticmethod
+    async def _stream_output(output: str, run_manager: AsyncCallbackManagerForToolRun) -> str:
+        """Sends partial output of the tool to the callback handlers, before the tool run completes."""
+        await adispatch_custom_event(TOOL_OUTPUT_EVENT, output, config={"callbacks": run_manager.get_child()})
+        return output
+
+
+class TimeWindowArgs(BaseModel):
+    minutes: int = Field(10, ge=1, description="The number of minutes, until now, to get the information from. "
+                                               "Eg: 60 for the last hour, 1440 for the last day or 10080 for the last "
+                                               "week")
+
 
 class ServicesMetricsTool(AgentTool):
     name = "get_services_metrics"
-    description = "gets the metrics of all services in the last 10 minutes"
+    description = "gets the metrics of all services in a time window, by default the last 10 minutes"
+    args_schema: Type[BaseModel] = TimeWindowArgs
 
-    async def _arun(self) -> str:
+    async def _arun(self, minutes: int = 10, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
+        time_range = TimeRange.from_last_minutes(minutes)
+        return await self._solve_cached((minutes,), time_range,
+                                        lambda emit: self._find_services_metrics(time_range, emit), run_manager)
+
+    async def _find_services_metrics(self, time_range: TimeRange, emit: Callable[[str], str]) -> str:
         services = await self.sw_api.find_services()
-        service_metrics = await self.sw_api.find_services_summary_metrics(services, TimeRange.from_last_minutes(10))
-        return solve_response("services-metrics",
-                              {"service_metrics": service_metrics, "sw_url": self.sw_api.services_url})
+        # the table is streamed so users get rows as soon as they are available instead of waiting for all of them
+        ret = [emit(solve_response_macro("services-metrics", "header"))]
+        async for service_metrics in self.sw_api.iter_services_summary_metrics(services, time_range):
+            ret.append(emit(solve_response_macro("services-metrics", "rows", service_metrics)))
+        ret.append(emit(solve_response_macro("services-metrics", "footer", self.sw_api.services_url)))
+        return "".join(ret)
+
+
+class ServicesTopologyArgs(TimeWindowArgs):
+    service_name: Optional[str] = Field(None, description="The name of a service to only get the services around it")
+    hops: int = Field(1, ge=1, le=5, description="The number of calls, from or to the given service, to include "
+                                                 "services within")
 
 
 class ServicesTopologyTool(AgentTool):
     name = "get_services_topology"
     description = """gets a diagram with the topology of services showing how are they connected.
-    This information is based on the calls made between services in the last 10 minutes"""
+    This information is based on the calls made between services in a time window, by default the last 10 minutes.
+    When a service name is provided, only the services around it are included"""
+    args_schema: Type[BaseModel] = ServicesTopologyArgs
+    # big meshes are pruned to keep diagrams readable
+    max_nodes: int = 50
 
-    async def _arun(self) -> str:
-        services = await self.sw_api.find_services()
-        topology = await self.sw_api.find_services_topology(services, TimeRange.from_last_minutes(10))
-        return self._topology_to_markdown(topology)
-
-    def _topology_to_markdown(self, topology: Topology) -> str:
-        node_ids = {}
-        nodes = {}
-        edges = []
-        for index, node in enumerate(topology.nodes):
-            if node.type == "USER":
-                continue
-            node_id = node.name
-            if re.search(r"\W", node_id):
-                node_id = f"{node.type.lower() if node.type else 'node'}{index}"
-            node_ids[node.id] = node_id
-            nodes[node_id] = node
-        for edge in topology.edges:
-            if node_ids.get(edge.source):
-                edges.append((node_ids[edge.source], node_ids[edge.target]))
+    async def _arun(self, minutes: int = 10, service_name: Optional[str] = None, hops: int = 1) -> str:
+        time_range = TimeRange.from_last_minutes(minutes)
+        return await self._solve_cached((minutes, service_name, hops), time_range,
+                                        lambda _: self._find_services_topology(minutes, service_name, hops))
+
+    async def _find_services_topology(self, minutes: int, service_name: Optional[str], hops: int) -> str:
+        catalog = await self.sw_api.find_services_catalog()
+        center_ids = []
+        if service_name:
+            center_ids = [service.id for service in catalog.find_matching(service_name)]
+            if not center_ids:
+                return f"Service {service_name} not found. Check the list of services and try again"
+        # the default time window is served from the topology snapshot, which avoids querying the server each time
+        topology = await self.sw_api.find_topology_snapshot() if minutes == self.sw_api.topology_minutes \
+            else await self.sw_api.find_services_topology(catalog.services, TimeRange.from_last_minutes(minutes))
+        graph = TopologyGraph.from_topology(topology)
+        if center_ids:
+            graph = graph.neighbourhood(center_ids, hops)
+        return self._topology_to_markdown(graph.limit_nodes(self.max_nodes, center_ids))
+
+    def _topology_to_markdown(self, graph: TopologyGraph) -> str:
+        diagram_ids = graph.diagram_ids()
+        nodes = {diagram_ids[node_id]: node for node_id, node in graph.nodes.items()}
+        edges = [(diagram_ids[source], diagram_ids[target]) for source, target in graph.edges]
         return solve_response("services-topology", {"nodes": nodes, "edges": edges, "sw_url": self.sw_api.services_url})
 
 
+class ServicesTopologyChangesTool(AgentTool):
+    name = "get_services_topology_changes"
+    description = """gets the recent changes in the topology of services: services which appeared or disappeared and
+    calls between services which started or stopped"""
+
+    async def _arun(self) -> str:
+        changes = await self.sw_api.find_topology_changes()
+        if not changes:
+            return "No changes have been detected in the topology of services recently."
+        topology = await self.sw_api.find_topology_snapshot()
+        # removed nodes are not part of the current topology, so their names are taken from the changes
+        node_names = {node.id: node.name for change in changes for node in change.removed_nodes}
+        node_names.update((node.id, node.name) for node in topology.nodes)
+        return solve_response("topology-changes", {"changes": changes, "node_names": node_names,
+                                                   "sw_url": self.sw_api.services_url})
+
+
 class ServiceMetricId(Enum):
     RESPONSE_TIME_AVERAGE = "response_time_average"
     RESPONSE_TIME_PERCENTILES = "response_time_percentiles"
@@ -66,7 +243,7 @@ class ServiceMetricId(Enum):
     QUEUE_AVERAGE_CONSUME_LATENCY = "queue_avg_consume_latency"
 
 
-class ServiceMetricArgs(BaseModel):
+class ServiceMetricArgs(TimeWindowArgs):
     service_name: str = Field(description="The name of the service to get the metrics from")
     metric: ServiceMetricId = Field(description="The metric to show in the chart")
 
@@ -78,28 +255,26 @@ class MetricChart:
         self.unit = unit
         self.expression = expression
 
-    def to_markdown(self, data: List[ServiceMetric], service_url: str) -> str:
-        x_vals = sorted(set([int(value.id) for metric in data for value in metric.values]))
+    def to_markdown(self, data: List[ServiceMetric], service_url: str, time_range: TimeRange, max_points: int) -> str:
+        x_vals, y_vals = downsample(*align_series([metric_to_arrays(metric) for metric in data]), max_points)
         series = []
         legends = []
-        for metric in data:
-            vals_idx = 0
-            y_vals = []
-            for x_val in x_vals:
-                point = metric.values[vals_idx] if vals_idx < len(metric.values) else None
-                if point and x_val == int(point.id):
-                    y_vals.append(float(point.value) if point.value else None)
-                    vals_idx += 1
-                else:
-                    y_vals.append(None)
-            serie = {"data": y_vals}
+        for metric, metric_y_vals in zip(data, y_vals):
+            serie = {"data": to_json_values(metric_y_vals)}
             if metric.labels:
                 serie["name"] = metric.labels[0]
                 legends.append(metric.labels[0])
             series.append(serie)
-            return solve_response("service-metric-chart",
-                                  {"title": self.title + (f" ({self.unit})" if self.unit else ""), "unit": self.unit,
-                                   "x_vals": x_vals, "legends": legends, "series": series, "sw_url": service_url})
+        return solve_response("service-metric-chart",
+                              {"title": self.title + (f" ({self.unit})" if self.unit else ""), "unit": self.unit,
+                               "x_vals": x_vals.tolist(), "x_format": _epoch_format(time_range), "legends": legends,
+                               "series": series, "sw_url": service_url})
+
+
+def _epoch_format(time_range: TimeRange) -> str:
+    if time_range.step == DurationStep.DAY:
+        return "YYYY-MM-DD"
+    return "HH:mm" if time_range.end - time_range.start <= datetime.timedelta(days=1) else "MM-DD HH:mm"
 
 
 metrics_charts = {
@@ -117,13 +292,21 @@ metrics_charts = {
 
 class ServiceMetricChartTool(AgentTool):
     name = "get_service_metric_chart"
-    description = "gets a chart showing the values of a particular metric and service in the last 10 minutes."
+    description = ("gets a chart showing the values of a particular metric and service in a time window, by default "
+                   "the last 10 minutes.")
     args_schema: Type[BaseModel] = ServiceMetricArgs
+    # long time windows are downsampled to keep charts small
+    chart_max_points: int = 200
 
-    async def _arun(self, service_name: str, metric: ServiceMetricId) -> str:
-        services = await self.sw_api.find_services()
-        candidates = [service for service in services if service_name == service.name]
-        services = candidates if candidates else [service for service in services if service_name in service.name]
+    async def _arun(self, service_name: str, metric: ServiceMetricId, minutes: int = 10) -> str:
+        time_range = TimeRange.from_last_minutes(minutes)
+        return await self._solve_cached((service_name, metric, minutes), time_range,
+                                        lambda _: self._find_service_metric_chart(service_name, metric, time_range))
+
+    async def _find_service_metric_chart(self, service_name: str, metric: ServiceMetricId,
+                                         time_range: TimeRange) -> str:
+        catalog = await self.sw_api.find_services_catalog()
+        services = catalog.find_matching(service_name)
         if not services:
             return f"Service {service_name} not found. Check the list of services and try again"
         if len(services) > 1:
@@ -135,7 +318,10 @@ class ServiceMetricChartTool(AgentTool):
             return (f"Metric `{metric}` not known. The list of available metrics is: "
                     f"{', '.join([metric.value for metric in metrics_charts.keys()])}.")
         result = await self.sw_api.find_services_metrics(services, {metric.value: metric_chart.expression},
-                                                         TimeRange.from_last_minutes(10))
+                                                         time_range)
+        if not result:
+            return f"No `{metric.value}` metric found for {services[0].shortName}. Please try again later."
         service_metrics = next(iter(result.values()))
         data = next(iter(service_metrics.values()))
-        return metric_chart.to_markdown(data, self.sw_api.get_service_url(services[0]))
+        return metric_chart.to_markdown(data, self.sw_api.get_service_url(services[0]), time_range,
+                                        self.chart_max_points)
@@ -1,21 +1,114 @@
-from typing import List, Dict
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, List, Dict, Optional
 
+from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import skywalking_copilot.database as database
 from skywalking_copilot import skywalking
+from skywalking_copilot.caching import SingleFlight, CacheBackend, InMemoryCacheBackend
 from skywalking_copilot.skywalking import AlarmEvent
 
+logger = logging.getLogger(__name__)
 
-async def find_new_alarms(
-        time_range: skywalking.TimeRange, limit: int, sw_api: skywalking.SkywalkingApi,
-        session_id: str, db: AsyncSession) -> List[AlarmEvent]:
-    alarms = await sw_api.find_alarms(time_range, limit)
+
+class AlarmsSnapshot(BaseModel):
+    polled_at: float
+    alarms: List[skywalking.Alarm]
+
+
+class AlarmsPoller:
+    """
+    Periodically polls latest alarms from Skywalking into a bounded buffer of snapshots, so sessions check for new
+    alarms against the latest snapshot instead of each one querying Skywalking.
+
+    Each time polled alarms differ from previous ones the snapshot version is increased, and waiters of
+    wait_for_change are notified.
+
+    When the cache backend is shared among workers, only the worker holding the poll lock on each interval queries
+    Skywalking, and the rest get the snapshot it stored in the cache.
+    """
+
+    _LOCK_KEY = "alarms:poll-lock"
+    _SNAPSHOT_KEY = "alarms:snapshot"
+
+    def __init__(self, sw_api: skywalking.SkywalkingApi, interval: float, minutes: int = 30, limit: int = 10,
+                 history_size: int = 10, cache: Optional[CacheBackend] = None):
+        self._sw_api = sw_api
+        self._cache = cache or InMemoryCacheBackend()
+        self._interval = interval
+        self._minutes = minutes
+        self._limit = limit
+        self._snapshots: Deque[AlarmsSnapshot] = deque(maxlen=history_size)
+        self._flight = SingleFlight()
+        self._version = 0
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _poll(self):
+        while True:
+            try:
+                await self._refresh()
+            except Exception:
+                logger.warning("Problem polling alarms", exc_info=True)
+            await asyncio.sleep(self._interval)
+
+    async def _refresh(self) -> AlarmsSnapshot:
+        return await self._flight.run(None, self._load)
+
+    async def _load(self) -> AlarmsSnapshot:
+        ret = await self._find_shared_snapshot()
+        if not ret:
+            alarms = await self._sw_api.find_alarms(skywalking.TimeRange.from_last_minutes(self._minutes), self._limit)
+            ret = AlarmsSnapshot(polled_at=time.time(), alarms=alarms)
+            # snapshots expire, so workers don't keep getting old ones if the worker polling alarms stops
+            await self._cache.set(self._SNAPSHOT_KEY, ret.model_dump_json(), self._interval * 3)
+        changed = not self._snapshots or self._snapshots[-1].alarms != ret.alarms
+        self._snapshots.append(ret)
+        if changed:
+            async with self._changed:
+                self._version += 1
+                self._changed.notify_all()
+        return ret
+
+    async def _find_shared_snapshot(self) -> Optional[AlarmsSnapshot]:
+        # the lock expires a bit before the interval, so the worker holding it can usually take it again on next poll
+        if await self._cache.acquire(self._LOCK_KEY, self._interval * 0.9):
+            return None
+        cached = await self._cache.get(self._SNAPSHOT_KEY)
+        return AlarmsSnapshot.model_validate_json(cached) if cached else None
+
+    async def latest(self) -> AlarmsSnapshot:
+        # until the first poll succeeds, callers wait for an on demand poll shared among them
+        return self._snapshots[-1] if self._snapshots else await self._refresh()
+
+    async def wait_for_change(self, version: int = 0) -> int:
+        """Waits until snapshot version differs from the given one (0 for no snapshot), and returns the new version."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._version != version)
+            return self._version
+
+
+async def find_new_alarms(poller: AlarmsPoller, session_id: str, db: AsyncSession) -> List[AlarmEvent]:
+    alarms = (await poller.latest()).alarms
     events = _group_events_by_alarm_id_and_service(alarms)
-    events_repo = database.AlarmEventsRepository(db)
-    known_events_list = await events_repo.find_by_session_id(session_id)
-    known_events = _group_known_events_by_alarm_id_and_service(known_events_list)
-    return await _find_new_events(events, known_events, session_id, events_repo)
+    return await _find_new_events(events, session_id, database.AlarmEventsRepository(db))
 
 
 def _group_events_by_alarm_id_and_service(alarms: List[skywalking.Alarm]) \
@@ -32,35 +125,17 @@ def _group_events_by_alarm_id_and_service(alarms: List[skywalking.Alarm]) \
     return ret
 
 
-def _group_known_events_by_alarm_id_and_service(known_events: List[database.AlarmEvent]) \
-        -> Dict[str, Dict[str, database.AlarmEvent]]:
-    ret = {}
-    for event in known_events:
-        if event.alarm_id not in ret:
-            ret[event.alarm_id] = {}
-        ret[event.alarm_id][event.service] = event
-    return ret
-
-
 async def _find_new_events(
-        events: Dict[str, Dict[str, skywalking.AlarmEvent]], known_events: Dict[str, Dict[str, database.AlarmEvent]],
-        session_id: str, events_repo: database.AlarmEventsRepository) -> List[skywalking.AlarmEvent]:
-    ret = []
-    for alarm_id, events_by_service in events.items():
-        for service_name, event in events_by_service.items():
-            if alarm_id not in known_events or service_name not in known_events[alarm_id]:
-                ret.append(event)
-                await events_repo.save(_build_database_event(session_id, alarm_id, event))
-            else:
-                known_event = known_events[alarm_id][service_name]
-                if known_event.id != event.uuid:
-                    ret.append(event)
-                    await events_repo.delete(known_event)
-                    await events_repo.save(_build_database_event(session_id, alarm_id, event))
-    return ret
+        events: Dict[str, Dict[str, skywalking.AlarmEvent]], session_id: str,
+        events_repo: database.AlarmEventsRepository) -> List[skywalking.AlarmEvent]:
+    changed = set(await events_repo.upsert([_build_database_event(session_id, alarm_id, event)
+                                            for alarm_id, events_by_service in events.items()
+                                            for event in events_by_service.values()]))
+    return [event for alarm_id, events_by_service in events.items()
+            for service_name, event in events_by_service.items() if (alarm_id, service_name) in changed]
 
 
 def _build_database_event(session_id: str, alarm_id: str, event: skywalking.AlarmEvent) -> database.AlarmEvent:
     return database.AlarmEvent(
-        session_id=session_id, alarm_id=alarm_id, id=event.uuid, event_type=event.type, start_time=event.start_time,
-        end_time=event.end_time, service=event.source.service, message=event.message)
+        session_id=session_id, alarm_id=alarm_id, id=event.uuid, event_type=event.type.value,
+        start_time=event.start_time, end_time=event.end_time, service=event.source.service, message=event.message)
@@ -1,37 +1,74 @@
 import asyncio
 import logging
 import os
-from typing import Annotated, AsyncIterator, Dict, List, Optional
+import random
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional
 
 from fastapi import FastAPI, HTTPException, status, Depends, Request, Body
 from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sse_starlette.sse import ServerSentEvent
+from sse_starlette.sse import ServerSentEvent, EventSourceResponse
 
-from skywalking_copilot.agent import Agent
-from skywalking_copilot.alarms import find_new_alarms
-from skywalking_copilot.database import get_db, SessionsRepository, QuestionsRepository, get_raw_connection
+from skywalking_copilot.agent import AgentFactory, AnswerEventType
+from skywalking_copilot.alarms import find_new_alarms, AlarmsPoller
+from skywalking_copilot.caching import build_cache_backend
+from skywalking_copilot.database import get_db, SessionsRepository, async_session, history_pool, get_pools_stats, \
+    questions_writes, chat_messages_writes
 from skywalking_copilot.domain import SessionBase, Session, Question
-from skywalking_copilot.skywalking import SkywalkingApi, TimeRange, AlarmEvent, TraceSpan
+from skywalking_copilot.memory import chat_summaries
+from skywalking_copilot.metrics import metrics
+from skywalking_copilot.skywalking import SkywalkingApi, AlarmEvent, TraceSpan
 from skywalking_copilot.templates import solve_response
+from skywalking_copilot.traces import build_spans_context, count_spans, summarize_spans
 
 app = FastAPI()
 assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets')
 templates = Jinja2Templates(directory=assets_path)
-sw_api = SkywalkingApi(os.getenv("SKYWALKING_URL"))
+# when running multiple workers, a shared cache backend (eg: redis://localhost:6379) avoids each one querying Skywalking
+cache = build_cache_backend(os.getenv("CACHE_URL"))
+sw_api = SkywalkingApi(os.getenv("SKYWALKING_URL"),
+                       services_ttl=float(os.getenv("SKYWALKING_SERVICES_TTL_SECONDS", 60)),
+                       traces_cache_size=int(os.getenv("TRACES_CACHE_SIZE", 1000)),
+                       traces_cache_ttl=float(os.getenv("TRACES_CACHE_TTL_SECONDS", 60)),
+                       batch_window=float(os.getenv("SKYWALKING_BATCH_WINDOW_SECONDS", 0)),
+                       batch_max_fields=int(os.getenv("SKYWALKING_BATCH_MAX_FIELDS", 100)),
+                       metrics_chunk_size=int(os.getenv("SKYWALKING_METRICS_CHUNK_SIZE", 50)),
+                       metrics_concurrency=int(os.getenv("SKYWALKING_METRICS_CONCURRENCY", 4)),
+                       topology_ttl=float(os.getenv("SKYWALKING_TOPOLOGY_TTL_SECONDS", 60)),
+                       topology_changes_size=int(os.getenv("SKYWALKING_TOPOLOGY_CHANGES_SIZE", 10)),
+                       cache=cache)
+agent_factory = AgentFactory(sw_api, cache)
+alarms_poller = AlarmsPoller(sw_api, float(os.getenv("ALARMS_POLL_INTERVAL_SECONDS", 15)), cache=cache)
+traces_deadline = float(os.getenv("TRACES_DEADLINE_SECONDS", 20))
+traces_concurrency = int(os.getenv("TRACES_CONCURRENCY", 5))
+traces_summary_threshold = int(os.getenv("TRACES_SUMMARY_THRESHOLD", 50))
+traces_summary_top = int(os.getenv("TRACES_SUMMARY_TOP", 10))
 logger = logging.getLogger(__name__)
 
 
 @app.on_event("startup")
 async def startup_event():
+    await history_pool.open()
+    questions_writes.start()
+    chat_messages_writes.start()
+    chat_summaries.start()
     await sw_api.connect()
+    alarms_poller.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await alarms_poller.stop()
     await sw_api.close()
+    # pending writes are flushed before closing connections
+    await questions_writes.stop()
+    # summaries wait for pending chat messages, so they are stopped first
+    await chat_summaries.stop()
+    await chat_messages_writes.stop()
+    await history_pool.close()
+    await cache.close()
 
 
 @app.get('/manifest.json')
@@ -46,14 +83,18 @@ async def get_logo() -> FileResponse:
     return FileResponse(os.path.join(assets_path, 'logo.png'))
 
 
+@app.get('/metrics')
+async def get_metrics() -> Dict[str, Any]:
+    return {**metrics.snapshot(), "db_pools": get_pools_stats()}
+
+
 @app.post('/sessions', status_code=status.HTTP_201_CREATED)
 async def create_session(
         req: SessionBase,
         db: Annotated[AsyncSession, Depends(get_db)]) -> Session:
     ret = Session(**req.model_dump())
     await SessionsRepository(db).save(ret)
-    conn = await get_raw_connection(db)
-    await Agent(ret, conn, sw_api).start_session()
+    await agent_factory.create(ret).start_session()
     return ret
 
 
@@ -73,25 +114,26 @@ async def answer_question(
         session_id: str, req: QuestionRequest,
         db: Annotated[AsyncSession, Depends(get_db)]) -> Response:
     session = await _find_session(session_id, db)
-    return StreamingResponse(agent_response_stream(req, session, db), media_type="text/event-stream")
+    return StreamingResponse(agent_response_stream(req, session), media_type="text/event-stream")
 
 
-async def agent_response_stream(
-        req: QuestionRequest,
-        session: Session,
-        db: AsyncSession) -> AsyncIterator[str]:
+async def agent_response_stream(req: QuestionRequest, session: Session) -> AsyncIterator[str]:
     try:
-        conn = await get_raw_connection(db)
-        answer_stream = Agent(session, conn, sw_api).ask(req.question)
-        complete_answer = ""
-        async for token in answer_stream:
-            complete_answer = complete_answer + token
-            yield ServerSentEvent(data=token).encode()
-        ret = Question(question=req.question, answer=complete_answer, session=session)
-        await QuestionsRepository(db).save(ret)
+        answer_stream = agent_factory.create(session).ask(req.question)
+        tokens = []
+        async for event in answer_stream:
+            # tokens are sent as default events, so clients only aware of them keep working
+            if event.type == AnswerEventType.TOKEN:
+                tokens.append(event.data)
+                yield ServerSentEvent(data=event.data).encode()
+            else:
+                # events are always sent with a data line (even if empty), since clients drop events without data
+                yield ServerSentEvent(event=event.type.value, data=event.data).encode()
+        ret = Question(question=req.question, answer="".join(tokens), session=session)
+        await questions_writes.put(session.id, ret)
     except Exception:
         logger.exception("Problem answering question")
-        yield ServerSentEvent(event="error").encode()
+        yield ServerSentEvent(event="error", data="").encode()
 
 
 class InteractionResponse(BaseModel):
@@ -112,59 +154,76 @@ async def record_interaction(
         spans = await _await_found_trace([trace.traceId for trace in traces])
         service = await sw_api.find_service_by_name(spans[0].service) if spans else None
         return InteractionResponse(
-            summary=solve_response("traces", {"spans": _build_spans_context(spans),
-                                              "sw_url": sw_api.get_service_url(service)}) if spans else "")
+            summary=_build_traces_summary(spans, sw_api.get_service_url(service)) if spans else "")
     else:
-        alarms = await find_new_alarms(TimeRange.from_last_minutes(30), 10, sw_api, session_id, db)
+        alarms = await find_new_alarms(alarms_poller, session_id, db)
         return InteractionResponse(
             summary=solve_response("alarms", {"alarms": await _build_alarms_context(alarms)}) if alarms else "")
 
 
+@app.get('/sessions/{session_id}/alarms/stream')
+async def stream_alarms(session_id: str, db: Annotated[AsyncSession, Depends(get_db)]) -> Response:
+    await _find_session(session_id, db)
+    return EventSourceResponse(alarms_stream(session_id))
+
+
+async def alarms_stream(session_id: str) -> AsyncIterator[ServerSentEvent]:
+    version = 0
+    while True:
+        version = await alarms_poller.wait_for_change(version)
+        try:
+            # a short-lived db session per change avoids holding a connection while the stream is idle
+            async with async_session() as db:
+                alarms = await find_new_alarms(alarms_poller, session_id, db)
+            if alarms:
+                yield ServerSentEvent(data=solve_response("alarms", {"alarms": await _build_alarms_context(alarms)}),
+                                      event="alarms")
+        except Exception:
+            logger.exception("Problem streaming alarms")
+            yield ServerSentEvent(event="error", data="")
+
+
+def _build_traces_summary(spans: List[TraceSpan], sw_url: str) -> str:
+    # big traces are summarized to keep the response size bounded
+    if count_spans(spans) > traces_summary_threshold:
+        return solve_response("traces-summary", {**summarize_spans(spans, traces_summary_top), "sw_url": sw_url})
+    return solve_response("traces", {"spans": build_spans_context(spans), "sw_url": sw_url})
+
+
 async def _await_found_trace(trace_ids: List[str]) -> List[TraceSpan]:
-    spans = []
-    for trace_id in trace_ids:
-        spans += await sw_api.find_trace_spans(trace_id)
-    max_retries = 4
-    retries = 0
-    while not spans and retries < max_retries:
-        await asyncio.sleep(5)
-        for trace_id in trace_ids:
-            spans += await sw_api.find_trace_spans(trace_id)
-        retries += 1
-    return spans
-
-
-def _build_spans_context(spans: List[TraceSpan], prefix: str = "") -> List[Dict]:
-    ret = []
-    for idx, span in enumerate(spans):
-        ret.append({
-            'prefix': prefix + ("└─ " if idx == len(spans) - 1 else "├─ "),
-            'name': _build_span_name(span),
-            'duration': span.end_time - span.start_time
-        })
-        ret += _build_spans_context(span.children, prefix + ("    " if idx == len(spans) - 1 else "│   "))
-    return ret
+    try:
+        async with asyncio.timeout(traces_deadline):
+            return await _find_traces_spans_with_backoff(trace_ids)
+    except TimeoutError:
+        logger.warning(f"No spans found for traces {trace_ids} after {traces_deadline}s")
+        return []
+
+
+async def _find_traces_spans_with_backoff(trace_ids: List[str]) -> List[TraceSpan]:
+    semaphore = asyncio.Semaphore(traces_concurrency)
 
+    async def find_trace_spans(trace_id: str) -> List[TraceSpan]:
+        async with semaphore:
+            return await sw_api.find_trace_spans(trace_id)
 
-def _build_span_name(span: TraceSpan) -> str:
-    if span.layer == 'Http':
-        return f"{span.tags.get('http.method', 'GET')} {span.tags.get('url') or span.tags.get('http.url')
-                                                        or span.endpoint}"
-    elif span.layer == 'Database':
-        return f"@{span.peer} {span.tags.get('db.statement') or span.endpoint}"
-    elif span.layer == 'MQ':
-        return f"@{span.peer} {span.endpoint}"
-    return span.endpoint
+    backoff = 0.5
+    while True:
+        traces_spans = await asyncio.gather(*[find_trace_spans(trace_id) for trace_id in trace_ids])
+        spans = [span for trace_spans in traces_spans for span in trace_spans]
+        # retrying stops once any trace is found, providing spans of all found traces
+        if spans:
+            return spans
+        await asyncio.sleep(backoff / 2 + random.uniform(0, backoff / 2))
+        backoff = min(backoff * 2, 8)
 
 
 async def _build_alarms_context(alarms: List[AlarmEvent]) -> List[Dict]:
-    services = await sw_api.find_services()
-    services_map = {service.name: service for service in services}
+    catalog = await sw_api.find_services_catalog()
     return [{
         'start': alarm.start_time.strftime('%H:%M'),
         'end': alarm.end_time.strftime('%H:%M'),
         'type': alarm.type.value,
         'service_name': alarm.source.service,
-        'service_url': sw_api.get_service_url(services_map[alarm.source.service]),
+        'service_url': sw_api.get_service_url(catalog.find_by_name(alarm.source.service)),
         'message': alarm.message
     } for alarm in alarms]
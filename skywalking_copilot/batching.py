@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from gql.transport.exceptions import TransportQueryError
+from graphql import DocumentNode, FieldNode, NameNode, OperationDefinitionNode, OperationType, SelectionSetNode, \
+    VariableDefinitionNode, VariableNode, Visitor, visit, FragmentDefinitionNode
+
+from skywalking_copilot.caching import LruCache
+from skywalking_copilot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingQuery:
+    document: DocumentNode
+    variables: Dict[str, Any]
+    fields_count: int
+    future: asyncio.Future
+
+
+class QueryBatcher:
+    """
+    Merges GraphQL queries issued within the same window into aliased documents, so they are solved with a single
+    round trip to the server, and fans out results to each caller. Variables of each query are prefixed in the same way
+    as its fields, to avoid collisions between queries. Fragments are shared among queries, so they should not use
+    variables, and fragments with same name are expected to be equal.
+
+    Merged documents are limited to max_fields top level fields to avoid hitting server limits. A query with more
+    fields than max_fields is sent on its own.
+
+    Queries of cancelled callers are not sent, and a request in flight is cancelled when all its callers are cancelled.
+    """
+
+    def __init__(self, execute: Callable[[DocumentNode, Dict[str, Any]], Awaitable[dict]], window: float = 0,
+                 max_fields: int = 100):
+        self._execute = execute
+        self._window = window
+        self._max_fields = max_fields
+        self._pending: List[_PendingQuery] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # documents are usually static, so we avoid re-processing them on each merge
+        self._prefixed_operations: LruCache[Tuple[int, int], Tuple[DocumentNode, _PrefixedOperation]] = \
+            LruCache(max_fields * 10)
+
+    async def query(self, document: DocumentNode, variables: Dict[str, Any]) -> dict:
+        fields_count = len(_find_operation(document).selection_set.selections)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(_PendingQuery(document, variables, fields_count, future))
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+        return await future
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self._window)
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+        # queries whose callers were cancelled while waiting for the window are not sent
+        active = [query for query in pending if not query.future.cancelled()]
+        if len(active) < len(pending):
+            metrics.increment("skywalking.cancelled_queries", len(pending) - len(active))
+        tasks = []
+        for batch in self._split_batches(active):
+            task = asyncio.create_task(self._execute_batch(batch))
+            for query in batch:
+                query.future.add_done_callback(lambda _, b=batch, t=task: _cancel_abandoned_batch(b, t))
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _split_batches(self, pending: List[_PendingQuery]) -> List[List[_PendingQuery]]:
+        ret = []
+        batch = []
+        batch_fields = 0
+        for query in pending:
+            fields = query.fields_count
+            if batch and batch_fields + fields > self._max_fields:
+                ret.append(batch)
+                batch = []
+                batch_fields = 0
+            batch.append(query)
+            batch_fields += fields
+        if batch:
+            ret.append(batch)
+        return ret
+
+    async def _execute_batch(self, batch: List[_PendingQuery]):
+        if len(batch) == 1:
+            await self._execute_single(batch[0])
+            return
+        try:
+            results = await self.query_all([(query.document, query.variables) for query in batch])
+        except TransportQueryError:
+            # an error in one of the queries should not affect the rest, so we send them separately
+            logger.warning("Problem executing merged queries, retrying them separately", exc_info=True)
+            await asyncio.gather(*[self._execute_single(query) for query in batch])
+            return
+        except Exception as e:
+            for query in batch:
+                _set_exception(query.future, e)
+            return
+        for query, result in zip(batch, results):
+            _set_result(query.future, result)
+
+    async def query_all(self, queries: List[Tuple[DocumentNode, Dict[str, Any]]]) -> List[dict]:
+        """Solves the given queries in one request, without waiting for other queries nor applying max_fields limit."""
+        logger.debug(f"Merging {len(queries)} queries in one request")
+        operations = [self._prefix_operation(document, idx) for idx, (document, _) in enumerate(queries)]
+        variables = {operation.prefix + variable: value for operation, (_, query_variables) in zip(operations, queries)
+                     for variable, value in query_variables.items()}
+        result = await self._execute(_merge_operations(operations), variables)
+        return [{key: result.get(operation.prefix + key) for key in operation.response_keys}
+                for operation in operations]
+
+    def _prefix_operation(self, document: DocumentNode, idx: int) -> '_PrefixedOperation':
+        key = (id(document), idx)
+        cached = self._prefixed_operations.get(key)
+        # keeping a reference to the document in the cache guarantees its id is not reused by another document
+        if cached and cached[0] is document:
+            return cached[1]
+        ret = _PrefixedOperation(document, _alias_prefix(idx))
+        self._prefixed_operations.set(key, (document, ret))
+        return ret
+
+    async def _execute_single(self, query: _PendingQuery):
+        try:
+            _set_result(query.future, await self._execute(query.document, query.variables))
+        except Exception as e:
+            _set_exception(query.future, e)
+
+
+def _cancel_abandoned_batch(batch: List[_PendingQuery], task: asyncio.Task):
+    if not task.done() and all(query.future.cancelled() for query in batch):
+        metrics.increment("skywalking.cancelled_queries", len(batch))
+        task.cancel()
+
+
+def _set_result(future: asyncio.Future, result: dict):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: Exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def _find_operation(document: DocumentNode) -> OperationDefinitionNode:
+    operations = [d for d in document.definitions if isinstance(d, OperationDefinitionNode)]
+    if len(operations) != 1 or operations[0].operation != OperationType.QUERY:
+        raise ValueError("Only documents with a single query can be merged")
+    return operations[0]
+
+
+def _alias_prefix(idx: int) -> str:
+    return f"q{idx}_"
+
+
+def _response_key(field: FieldNode) -> str:
+    return field.alias.value if field.alias else field.name.value
+
+
+class _PrefixedOperation:
+
+    def __init__(self, document: DocumentNode, prefix: str):
+        operation = _find_operation(document)
+        self.prefix = prefix
+        self.fragments = [d for d in document.definitions if isinstance(d, FragmentDefinitionNode)]
+        self.response_keys = [_response_key(field) for field in operation.selection_set.selections]
+        operation = visit(operation, _VariablesPrefixer(prefix))
+        self.variable_definitions: List[VariableDefinitionNode] = list(operation.variable_definitions)
+        self.selections = [FieldNode(
+            alias=NameNode(value=prefix + _response_key(field)), name=field.name, arguments=field.arguments,
+            directives=field.directives, selection_set=field.selection_set)
+            for field in operation.selection_set.selections]
+
+
+class _VariablesPrefixer(Visitor):
+
+    def __init__(self, prefix: str):
+        super().__init__()
+        self._prefix = prefix
+
+    def enter_variable(self, node: VariableNode, *_) -> VariableNode:
+        return VariableNode(name=NameNode(value=self._prefix + node.name.value))
+
+
+def _merge_operations(operations: List[_PrefixedOperation]) -> DocumentNode:
+    variable_definitions = [definition for operation in operations for definition in operation.variable_definitions]
+    selections = [field for operation in operations for field in operation.selections]
+    fragments = {fragment.name.value: fragment for operation in operations for fragment in operation.fragments}
+    merged = OperationDefinitionNode(
+        operation=OperationType.QUERY, name=NameNode(value="batchQuery"), directives=[],
+        variable_definitions=variable_definitions, selection_set=SelectionSetNode(selections=selections))
+    return DocumentNode(definitions=[merged, *fragments.values()])
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class _Flight:
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key so the underlying work is only run once at a time.
+
+    The work is cancelled when all callers waiting for it are cancelled, since nobody would use its result.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Flight] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        flight = self._calls.get(key)
+        if not flight:
+            flight = _Flight(asyncio.create_task(fn()))
+            self._calls[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        flight.waiters += 1
+        try:
+            # shield the shared task so a cancelled caller does not cancel the work other callers are waiting for
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # forget it right away, so new callers don't join the cancelled work
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._calls.get(key) is flight:
+            del self._calls[key]
+
+
+class CachedValue(Generic[T]):
+    """
+    Keeps a value loaded with the given loader for ttl seconds.
+
+    Once expired, the stale value is still returned while a refresh runs in the background, so only the first load
+    (or a load after invalidation) makes callers wait. Concurrent loads are coalesced into one loader call.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[T]], ttl: float):
+        self._loader = loader
+        self._ttl = ttl
+        self._value: Optional[T] = None
+        self._loaded_at: Optional[float] = None
+        self._flight = SingleFlight()
+        self._background_refresh: Optional[asyncio.Task] = None
+
+    async def get(self) -> T:
+        if self._loaded_at is None:
+            return await self._refresh()
+        if time.monotonic() - self._loaded_at > self._ttl:
+            self._refresh_in_background()
+        return self._value
+
+    async def get_fresh(self) -> T:
+        """Gets the value, waiting for a refresh when expired instead of returning the stale one."""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self._ttl:
+            return await self._refresh()
+        return self._value
+
+    async def _refresh(self) -> T:
+        return await self._flight.run(None, self._load)
+
+    async def _load(self) -> T:
+        value = await self._loader()
+        self._value = value
+        self._loaded_at = time.monotonic()
+        return value
+
+    def _refresh_in_background(self):
+        if self._background_refresh and not self._background_refresh.done():
+            return
+        self._background_refresh = asyncio.create_task(self._safe_refresh())
+
+    async def _safe_refresh(self):
+        try:
+            await self._refresh()
+        except Exception:
+            logger.warning("Problem refreshing cached value, keeping stale one", exc_info=True)
+
+    def invalidate(self):
+        self._value = None
+        self._loaded_at = None
+
+
+class LruCache(Generic[K, V]):
+    """Bounded in memory cache evicting least recently used entries, and optionally expiring them after ttl seconds."""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[K, Tuple[V, Optional[float]]] = OrderedDict()
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None):
+        """Sets the value of the key, expiring after given ttl, or after the cache ttl when not given."""
+        ttl = ttl if ttl is not None else self._ttl
+        self._entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CacheBackend(ABC):
+    """
+    Key value store for state which may be shared among workers, like services, tools results or alarms snapshots.
+
+    Values are strings (usually json), to allow storing them out of process.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        pass
+
+    @abstractmethod
+    async def acquire(self, key: str, ttl: float) -> bool:
+        """Sets the key only if not already set, and returns if it was set. Allows using keys as expiring locks."""
+
+    async def close(self):
+        pass
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """Cache backend for a single worker, keeping values in the worker memory."""
+
+    def __init__(self, max_size: int = 10000):
+        self._entries: LruCache[str, str] = LruCache(max_size)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._entries.set(key, value, ttl)
+
+    async def acquire(self, key: str, ttl: float) -> bool:
+        if self._entries.get(key) is not None:
+            return False
+        self._entries.set(key, "", ttl)
+        return True
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache backend shared among workers, using a server compatible with Redis protocol."""
+
+    def __init__(self, url: str, prefix: str = "skywalking-copilot:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise ImportError("redis package is required to use a redis cache, install the redis extra to use it") \
+                from e
+        self._client = redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._client.get(self._prefix + key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self._client.set(self._prefix + key, value, px=int(ttl * 1000) if ttl is not None else None)
+
+    async def acquire(self, key: str, ttl: float) -> bool:
+        return bool(await self._client.set(self._prefix + key, "", nx=True, px=int(ttl * 1000)))
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def build_cache_backend(url: Optional[str]) -> CacheBackend:
+    return RedisCacheBackend(url) if url else InMemoryCacheBackend()
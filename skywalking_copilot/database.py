@@ -1,21 +1,32 @@
 import os
 import datetime
 import uuid
-from typing import List
+from typing import Any, Dict, List, Tuple
 
-from psycopg import AsyncConnection
-from sqlalchemy import select, ForeignKey, PrimaryKeyConstraint
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool
+from sqlalchemy import select, ForeignKey, PrimaryKeyConstraint, make_url
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column
 
 from skywalking_copilot import domain
+from skywalking_copilot.write_behind import WriteBehindQueue
 
 db_url = os.getenv("DB_URL")
-engine = create_async_engine(db_url)
+engine = create_async_engine(db_url, pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+                             max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", 10)),
+                             pool_timeout=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 30)))
 async_session = async_sessionmaker(engine, autoflush=True, autocommit=False, expire_on_commit=False)
+# chat history is accessed with raw psycopg connections, taken from a dedicated pool only while reading or writing it
+history_pool = AsyncConnectionPool(make_url(db_url).set(drivername="postgresql").render_as_string(hide_password=False),
+                                   min_size=int(os.getenv("DB_HISTORY_POOL_MIN_SIZE", 2)),
+                                   max_size=int(os.getenv("DB_HISTORY_POOL_MAX_SIZE", 10)),
+                                   timeout=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 30)), open=False)
 Base = declarative_base()
 CHAT_HISTORY_TABLE = 'chat_history'
+CHAT_SUMMARY_TABLE = 'chat_summaries'
 
 
 async def get_db() -> AsyncSession:
@@ -23,10 +34,15 @@ async def get_db() -> AsyncSession:
         yield session
 
 
-async def get_raw_connection(db: AsyncSession) -> AsyncConnection:
-    conn = await db.connection()
-    raw_conn = await conn.get_raw_connection()
-    return raw_conn.driver_connection
+def get_pools_stats() -> Dict[str, Any]:
+    engine_pool = engine.sync_engine.pool
+    history_stats = history_pool.get_stats()
+    return {
+        "engine": {"size": engine_pool.size(), "checked_out": engine_pool.checkedout(),
+                   "overflow": engine_pool.overflow()},
+        "history": {**history_stats, "saturation": (history_stats.get("pool_size", 0)
+                                                    - history_stats.get("pool_available", 0)) / history_pool.max_size},
+    }
 
 
 class Session(Base):
@@ -58,6 +74,13 @@ class SessionsRepository:
         return ret.to_domain() if ret else None
 
 
+class ChatSummary(Base):
+    __tablename__ = CHAT_SUMMARY_TABLE
+    session_id: Mapped[str] = mapped_column(ForeignKey(Session.id), primary_key=True)
+    summary: Mapped[str] = mapped_column()
+    summarized_messages: Mapped[int] = mapped_column()
+
+
 class Question(Base):
     __tablename__ = "questions"
     id: Mapped[str] = mapped_column(primary_key=True)
@@ -76,8 +99,8 @@ class QuestionsRepository:
     def __init__(self, db: AsyncSession):
         self._db = db
 
-    async def save(self, question: domain.Question):
-        self._db.add(Question.from_domain(question))
+    async def save_all(self, questions: List[domain.Question]):
+        self._db.add_all([Question.from_domain(question) for question in questions])
         await self._db.commit()
 
 
@@ -101,15 +124,43 @@ class AlarmEventsRepository:
     def __init__(self, db: AsyncSession):
         self._db = db
 
-    async def save(self, alarm_event: AlarmEvent):
-        self._db.add(alarm_event)
+    async def upsert(self, alarm_events: List[AlarmEvent]) -> List[Tuple[str, str]]:
+        """
+        Saves the given events in one statement, replacing existing ones for the same session, alarm and service.
+
+        Returns the alarm id and service of events which are new or replaced a different event.
+        """
+        if not alarm_events:
+            return []
+        columns = [column.key for column in AlarmEvent.__table__.columns]
+        stmt = insert(AlarmEvent).values([{column: getattr(event, column) for column in columns}
+                                          for event in alarm_events])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AlarmEvent.session_id, AlarmEvent.alarm_id, AlarmEvent.service],
+            set_={column: stmt.excluded[column] for column in columns
+                  if column not in ('session_id', 'alarm_id', 'service')},
+            where=AlarmEvent.id != stmt.excluded.id
+        ).returning(AlarmEvent.alarm_id, AlarmEvent.service)
+        result = await self._db.execute(stmt)
+        ret = [(row.alarm_id, row.service) for row in result]
         await self._db.commit()
+        return ret
 
-    async def find_by_session_id(self, session_id: str) -> List[AlarmEvent]:
-        stmt = select(AlarmEvent).filter(AlarmEvent.session_id == session_id)
-        result = await self._db.execute(stmt)
-        return [a for a in result.scalars().all()]
 
-    async def delete(self, known_event: AlarmEvent):
-        await self._db.delete(known_event)
-        await self._db.commit()
+async def _save_questions(questions: List[domain.Question]):
+    async with async_session() as db:
+        await QuestionsRepository(db).save_all(questions)
+
+
+async def _save_chat_messages(messages: List[Tuple[str, str]]):
+    query = sql.SQL("INSERT INTO {table} (session_id, message) VALUES (%s, %s)") \
+        .format(table=sql.Identifier(CHAT_HISTORY_TABLE))
+    async with history_pool.connection() as conn, conn.cursor() as cursor:
+        await cursor.executemany(query, messages)
+
+
+# questions and chat messages (session id and serialized message) are written in the background to avoid keeping
+# requests and db connections busy while answers are streamed
+write_batch_size = int(os.getenv("DB_WRITE_BATCH_SIZE", 100))
+questions_writes = WriteBehindQueue("questions", _save_questions, write_batch_size)
+chat_messages_writes = WriteBehindQueue("chat_messages", _save_chat_messages, write_batch_size)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, get_buffer_string, \
+    messages_from_dict, message_to_dict
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.runnables import RunnableConfig
+from langchain_postgres import PostgresChatMessageHistory
+from psycopg import AsyncConnection, sql
+from psycopg_pool import AsyncConnectionPool
+
+from skywalking_copilot.database import CHAT_HISTORY_TABLE, CHAT_SUMMARY_TABLE
+from skywalking_copilot.metrics import metrics
+from skywalking_copilot.write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+_CHART_PATTERN = re.compile(r"```echarts\n.*?```", re.DOTALL)
+_DIAGRAM_PATTERN = re.compile(r"@startuml.*?@enduml", re.DOTALL)
+_TABLE_PATTERN = re.compile(r"(?:^\|.*\|[ \t]*(?:\n|$))+", re.MULTILINE)
+
+
+@asynccontextmanager
+async def _pool_connection(pool: AsyncConnectionPool) -> AsyncIterator[AsyncConnection]:
+    start = time.perf_counter()
+    async with pool.connection() as conn:
+        metrics.observe("db.history_pool_wait_ms", (time.perf_counter() - start) * 1000)
+        yield conn
+
+
+class PooledChatMessageHistory(BaseChatMessageHistory):
+    """
+    Postgres chat message history which takes a connection from the given pool on each read, instead of holding one
+    for the whole life of the history (which spans the whole streamed answer).
+
+    Messages are added through the given write behind queue, and reads wait for pending writes of the session.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, writes: WriteBehindQueue, table_name: str, session_id: str):
+        self._pool = pool
+        self._writes = writes
+        self._table_name = table_name
+        self._session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        raise NotImplementedError("Only async usage is supported")
+
+    def clear(self) -> None:
+        raise NotImplementedError("Only async usage is supported")
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        await self._writes.wait_written(self._session_id)
+        async with _pool_connection(self._pool) as conn:
+            return await self._build_history(conn).aget_messages()
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        for message in messages:
+            await self._writes.put(self._session_id, (self._session_id, json.dumps(message_to_dict(message))))
+
+    async def aclear(self) -> None:
+        await self._writes.wait_written(self._session_id)
+        async with _pool_connection(self._pool) as conn:
+            await self._build_history(conn).aclear()
+
+    def _build_history(self, conn: AsyncConnection) -> PostgresChatMessageHistory:
+        return PostgresChatMessageHistory(self._table_name, self._session_id, async_connection=conn)
+
+
+class WindowSummaryMemory(BaseChatMemory):
+    """
+    Chat memory which only provides the last window_turns turns of a session verbatim, preceded by a rolling summary
+    of previous turns.
+
+    The summary is persisted next to the chat history, and only messages not yet summarized are loaded from it. Tool
+    outputs (tables, charts and diagrams) of turns previous to the last one are replaced by short placeholders.
+
+    Summaries are updated in the background through the given summaries queue, which runs one summarization at a
+    time per session.
+    """
+    llm: BaseLanguageModel
+    pool: Any
+    writes: Any
+    summaries: Any
+    session_id: str
+    window_turns: int = 3
+    memory_key: str = "chat_history"
+    return_messages: bool = True
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError("Only async usage is supported")
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        summary, summarized_count = await self._find_summary()
+        turns = _split_turns(await self._find_messages(summarized_count))
+        ret = [SystemMessage(content=f"Summary of previous conversation: {summary}")] if summary else []
+        for turn in turns[:-1]:
+            ret += [_compact_message(message) for message in turn]
+        if turns:
+            ret += turns[-1]
+        return {self.memory_key: ret}
+
+    async def asave_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        await super().asave_context(inputs, outputs)
+        # old turns are summarized in the background, to avoid delaying the answer with an additional llm call
+        await self.summaries.put(self.session_id, self)
+
+    async def _summarize_old_turns(self):
+        summary, summarized_count = await self._find_summary()
+        turns = _split_turns(await self._find_messages(summarized_count))
+        if len(turns) <= self.window_turns:
+            return
+        old_messages = [_compact_message(message) for turn in turns[:-self.window_turns] for message in turn]
+        chain = SUMMARY_PROMPT | self.llm | StrOutputParser()
+        # callbacks are explicitly cleared to avoid streaming the summary as part of the answer
+        summary = await chain.ainvoke({"summary": summary, "new_lines": get_buffer_string(old_messages)},
+                                      RunnableConfig(callbacks=[]))
+        await self._save_summary(summary, summarized_count + len(old_messages))
+
+    async def _find_summary(self) -> Tuple[str, int]:
+        query = sql.SQL("SELECT summary, summarized_messages FROM {table} WHERE session_id = %(session_id)s") \
+            .format(table=sql.Identifier(CHAT_SUMMARY_TABLE))
+        async with _pool_connection(self.pool) as conn, conn.cursor() as cursor:
+            await cursor.execute(query, {"session_id": self.session_id})
+            row = await cursor.fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    async def _find_messages(self, offset: int) -> List[BaseMessage]:
+        await self.writes.wait_written(self.session_id)
+        query = sql.SQL("SELECT message FROM {table} WHERE session_id = %(session_id)s ORDER BY id OFFSET %(offset)s") \
+            .format(table=sql.Identifier(CHAT_HISTORY_TABLE))
+        async with _pool_connection(self.pool) as conn, conn.cursor() as cursor:
+            await cursor.execute(query, {"session_id": self.session_id, "offset": offset})
+            return messages_from_dict([record[0] for record in await cursor.fetchall()])
+
+    async def _save_summary(self, summary: str, summarized_count: int):
+        query = sql.SQL("INSERT INTO {table} (session_id, summary, summarized_messages) "
+                        "VALUES (%(session_id)s, %(summary)s, %(summarized_messages)s) "
+                        "ON CONFLICT (session_id) DO UPDATE "
+                        "SET summary = EXCLUDED.summary, summarized_messages = EXCLUDED.summarized_messages") \
+            .format(table=sql.Identifier(CHAT_SUMMARY_TABLE))
+        # the pool commits the transaction when returning the connection
+        async with _pool_connection(self.pool) as conn, conn.cursor() as cursor:
+            await cursor.execute(query, {"session_id": self.session_id, "summary": summary,
+                                         "summarized_messages": summarized_count})
+
+
+async def _summarize_sessions(memories: List[WindowSummaryMemory]):
+    # one summarization per session is enough, since each one summarizes all old turns of its session
+    sessions_memories = list({memory.session_id: memory for memory in memories}.values())
+    results = await asyncio.gather(*[memory._summarize_old_turns() for memory in sessions_memories],
+                                   return_exceptions=True)
+    for memory, result in zip(sessions_memories, results):
+        if isinstance(result, Exception):
+            logger.error(f"Problem summarizing chat history of session {memory.session_id}", exc_info=result)
+
+
+# summaries of sessions queued while others are being summarized are updated together in the next batch
+chat_summaries = WriteBehindQueue("chat_summaries", _summarize_sessions,
+                                  int(os.getenv("AGENT_MEMORY_SUMMARIES_BATCH_SIZE", 10)))
+
+
+def _split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    ret = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not ret:
+            ret.append([message])
+        else:
+            ret[-1].append(message)
+    return ret
+
+
+def _compact_message(message: BaseMessage) -> BaseMessage:
+    if not isinstance(message, AIMessage):
+        return message
+    content = _CHART_PATTERN.sub("[chart shown to the user]", message.content)
+    content = _DIAGRAM_PATTERN.sub("[diagram shown to the user]", content)
+    content = _TABLE_PATTERN.sub(
+        lambda match: f"[table with {max(len(match.group(0).splitlines()) - 2, 0)} rows shown to the user]\n", content)
+    return AIMessage(content=content) if content != message.content else message
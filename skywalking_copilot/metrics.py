@@ -0,0 +1,43 @@
+from typing import Dict, Any
+
+
+class Observation:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"count": self.count, "sum": self.total, "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max, "last": self.last}
+
+
+class Metrics:
+    """In process registry of counters and observed values, exposed by the api for troubleshooting and tuning."""
+
+    def __init__(self):
+        self._counters: Dict[str, float] = {}
+        self._observations: Dict[str, Observation] = {}
+
+    def increment(self, name: str, value: float = 1):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        self._observations.setdefault(name, Observation()).add(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "counters": dict(self._counters),
+            "observations": {name: observation.to_dict() for name, observation in self._observations.items()},
+        }
+
+
+metrics = Metrics()
@@ -0,0 +1,54 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from skywalking_copilot.skywalking import ServiceMetric
+
+
+def metric_to_arrays(metric: ServiceMetric) -> Tuple[np.ndarray, np.ndarray]:
+    """Gets arrays of timestamps and values of the metric points, ignoring points without timestamp."""
+    with_id = ~np.isnan(metric.ids)
+    return metric.ids[with_id].astype(np.int64), metric.values[with_id]
+
+
+def align_series(series: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Aligns series of (timestamps, values) to the union of their timestamps.
+
+    Returns the sorted timestamps, and a matrix with a row of values per series, with NaN where a series has no value
+    for a timestamp.
+    """
+    x_vals = np.unique(np.concatenate([ids for ids, _ in series])) if series else np.array([], dtype=np.int64)
+    y_vals = np.full((len(series), len(x_vals)), np.nan)
+    for row, (ids, values) in zip(y_vals, series):
+        row[np.searchsorted(x_vals, ids)] = values
+    return x_vals, y_vals
+
+
+def to_json_values(values: np.ndarray) -> List[Optional[float]]:
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def downsample(x_vals: np.ndarray, y_vals: np.ndarray, max_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduces aligned series to at most max_points points, splitting them in buckets and keeping the min and max value
+    of each series in each bucket, in the order they happened, so peaks and drops are still visible.
+
+    Values of a bucket are placed at the first and last timestamps of the bucket, since all series share timestamps.
+    """
+    if max_points < 2:
+        raise ValueError(f"At least 2 points are required to downsample series, but {max_points} were given")
+    if len(x_vals) <= max_points:
+        return x_vals, y_vals
+    size = -(-len(x_vals) // (max_points // 2))
+    buckets = -(-len(x_vals) // size)
+    padding = buckets * size - len(x_vals)
+    x_buckets = np.pad(x_vals, (0, padding), mode="edge").reshape(buckets, size)
+    y_buckets = np.pad(y_vals, ((0, 0), (0, padding)), constant_values=np.nan).reshape(len(y_vals), buckets, size)
+    # missing values are ignored, and buckets without values keep NaN since their first value is picked
+    min_idx = np.argmin(np.where(np.isnan(y_buckets), np.inf, y_buckets), axis=2)
+    max_idx = np.argmax(np.where(np.isnan(y_buckets), -np.inf, y_buckets), axis=2)
+    first = np.take_along_axis(y_buckets, np.minimum(min_idx, max_idx)[..., np.newaxis], axis=2)
+    last = np.take_along_axis(y_buckets, np.maximum(min_idx, max_idx)[..., np.newaxis], axis=2)
+    return (np.stack([x_buckets[:, 0], x_buckets[:, -1]], axis=1).reshape(-1),
+            np.concatenate([first, last], axis=2).reshape(len(y_vals), buckets * 2))
@@ -1,18 +1,42 @@
+import asyncio
 import datetime
+import json
 import logging
+import os
+import time
 import uuid
+from collections import deque
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 
+import numpy as np
 from gql import Client, gql
 from gql.transport.aiohttp import AIOHTTPTransport
-from pydantic import BaseModel
+from graphql import DocumentNode
+from pydantic import BaseModel, ConfigDict
 
-from skywalking_copilot.templates import solve_template
+from skywalking_copilot.batching import QueryBatcher
+from skywalking_copilot.caching import CachedValue, LruCache, CacheBackend, InMemoryCacheBackend
+from skywalking_copilot.metrics import metrics as metrics_registry
+from skywalking_copilot.templates import assets_path
 
 logger = logging.getLogger(__name__)
 
 
+def _load_queries() -> Dict[str, DocumentNode]:
+    queries_path = os.path.join(assets_path, 'graphql')
+    ret = {}
+    for file_name in os.listdir(queries_path):
+        with open(os.path.join(queries_path, file_name), encoding="utf-8") as f:
+            ret[os.path.splitext(file_name)[0]] = gql(f.read())
+    return ret
+
+
+# queries are parsed only once, and values are provided through variables when executing them
+queries = _load_queries()
+
+
 class Service(BaseModel):
     id: str
     name: str
@@ -21,27 +45,46 @@ class Service(BaseModel):
     shortName: str
     layers: List[str]
 
-    def to_gql(self) -> str:
-        return _val_to_gql({"serviceName": self.name, "normal": self.normal})
+    def to_gql_variable(self) -> Dict[str, Any]:
+        return {"serviceName": self.name, "normal": self.normal}
+
 
+class ServicesCatalog:
 
-def _val_to_gql(data: any) -> str:
-    if isinstance(data, str):
-        return f'"{data.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")}"'
-    elif isinstance(data, bool):
-        return "true" if data else "false"
-    elif isinstance(data, dict):
-        return f"{{{', '.join([f'{key}: {_val_to_gql(val)}' for key, val in data.items()])}}}"
-    elif isinstance(data, list):
-        return f"[{', '.join([_val_to_gql(val) for val in data])}]"
-    elif isinstance(data, Enum):
-        return data.value
-    else:
-        return str(data)
+    def __init__(self, services: List[Service]):
+        self.services = services
+        self._services_by_name = {service.name: service for service in services}
+
+    def find_by_name(self, service_name: str) -> Optional[Service]:
+        return self._services_by_name.get(service_name)
+
+    def find_matching(self, service_name: str) -> List[Service]:
+        service = self.find_by_name(service_name)
+        if service:
+            return [service]
+        return [service for service in self.services if service_name in service.name]
 
 
 class DurationStep(Enum):
     MINUTE = "MINUTE"
+    HOUR = "HOUR"
+    DAY = "DAY"
+
+    @staticmethod
+    def for_minutes(minutes: int) -> 'DurationStep':
+        """Picks the finest step which keeps the number of points of the given window manageable."""
+        if minutes <= 24 * 60:
+            return DurationStep.MINUTE
+        if minutes <= 31 * 24 * 60:
+            return DurationStep.HOUR
+        return DurationStep.DAY
+
+
+_STEP_FORMATS = {
+    DurationStep.MINUTE: "%Y-%m-%d %H%M",
+    DurationStep.HOUR: "%Y-%m-%d %H",
+    DurationStep.DAY: "%Y-%m-%d",
+}
 
 
 class TimeRange(BaseModel):
@@ -52,15 +95,16 @@ class TimeRange(BaseModel):
     @staticmethod
     def from_last_minutes(minutes: int) -> 'TimeRange':
         now = datetime.datetime.now(datetime.UTC)
-        return TimeRange(start=now - datetime.timedelta(minutes=minutes), end=now, step=DurationStep.MINUTE)
-
-    def to_gql(self) -> str:
-        duration = {
-            "start": self.start.strftime("%Y-%m-%d %H%M"),
-            "end": self.end.strftime("%Y-%m-%d %H%M"),
-            "step": self.step
+        return TimeRange(start=now - datetime.timedelta(minutes=minutes), end=now,
+                         step=DurationStep.for_minutes(minutes))
+
+    def to_gql_variable(self) -> Dict[str, Any]:
+        step_format = _STEP_FORMATS[self.step]
+        return {
+            "start": self.start.strftime(step_format),
+            "end": self.end.strftime(step_format),
+            "step": self.step.value
         }
-        return _val_to_gql(duration)
 
 
 class ServiceSummaryMetrics(BaseModel):
@@ -101,21 +145,47 @@ class Topology(BaseModel):
         return Topology(nodes=[TopologyNode.from_graphql(node) for node in data['nodes']],
                         edges=[TopologyEdge.from_graphql(edge) for edge in data['calls']])
 
+    def diff(self, previous: 'Topology') -> 'TopologyChanges':
+        nodes = {node.id: node for node in self.nodes}
+        previous_nodes = {node.id: node for node in previous.nodes}
+        edges = {(edge.source, edge.target): edge for edge in self.edges}
+        previous_edges = {(edge.source, edge.target): edge for edge in previous.edges}
+        return TopologyChanges(
+            detected_at=datetime.datetime.now(datetime.UTC),
+            added_nodes=[node for node_id, node in nodes.items() if node_id not in previous_nodes],
+            removed_nodes=[node for node_id, node in previous_nodes.items() if node_id not in nodes],
+            added_edges=[edge for key, edge in edges.items() if key not in previous_edges],
+            removed_edges=[edge for key, edge in previous_edges.items() if key not in edges])
+
+
+class TopologyChanges(BaseModel):
+    detected_at: datetime.datetime
+    added_nodes: List[TopologyNode]
+    removed_nodes: List[TopologyNode]
+    added_edges: List[TopologyEdge]
+    removed_edges: List[TopologyEdge]
 
-class ServiceMetricValue(BaseModel):
-    id: Optional[str]
-    value: Optional[str]
+    def is_empty(self) -> bool:
+        return not (self.added_nodes or self.removed_nodes or self.added_edges or self.removed_edges)
 
 
 class ServiceMetric(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
     labels: List[str]
-    values: List[ServiceMetricValue]
+    # timestamps and values are kept as arrays, with NaN for missing ones, to avoid an object per point in long series.
+    # Aggregated metrics (eg: avg(service_cpm)) have a single value without timestamp
+    ids: np.ndarray
+    values: np.ndarray
 
     @staticmethod
     def from_gql(data: dict) -> 'ServiceMetric':
+        points = data['values']
         return ServiceMetric(
             labels=[f"{label['key']}{label['value']}" for label in data['metric']['labels']],
-            values=[ServiceMetricValue(**val) for val in data['values']])
+            # epoch millis are exactly represented as floats, which allows NaN for points without timestamp
+            ids=np.array([value['id'] or "nan" for value in points], dtype=np.float64),
+            # numpy parses numeric strings, and "nan" for empty values
+            values=np.array([value['value'] or "nan" for value in points], dtype=np.float64))
 
 
 def _parse_epoch(epoch: int) -> datetime.datetime:
@@ -160,7 +230,12 @@ class TraceSpanType(Enum):
     LOCAL = "Local"
 
 
-class TraceSpan(BaseModel):
+@dataclass(slots=True)
+class TraceSpan:
+    """
+    Span of a trace and its simplified children. Uses a slotted dataclass instead of a pydantic model, since traces
+    may contain tens of thousands of spans.
+    """
     trace_id: str
     segment_id: str
     span_id: int
@@ -177,7 +252,7 @@ class TraceSpan(BaseModel):
     is_error: bool
     layer: str
     tags: Dict[str, str]
-    children: List['TraceSpan']
+    children: List['TraceSpan'] = field(default_factory=list)
 
     @staticmethod
     def from_gql(data: dict) -> 'TraceSpan':
@@ -192,16 +267,89 @@ class TraceSpan(BaseModel):
             service=data['serviceCode'], start_time=int(data['startTime']), end_time=int(data['endTime']),
             endpoint=data['endpointName'], type=TraceSpanType(data['type']), peer=data['peer'],
             component=data['component'], is_error=data['isError'], layer=data['layer'],
-            tags={t['key']: t['value'] for t in data['tags']}, children=[])
+            tags={t['key']: t['value'] for t in data['tags']})
+
+
+_FLATTENED_SPAN_TYPES = (TraceSpanType.LOCAL, TraceSpanType.ENTRY)
+
+
+def build_spans_tree(spans: List[TraceSpan]) -> List[TraceSpan]:
+    """
+    Links spans of each segment as children of the span referenced by the segment, and returns the root spans.
+    Entry and local spans are replaced by their children, so the tree only keeps exit spans under root spans.
+
+    Spans may come in any order, and the tree is traversed without recursion to support huge and deep traces.
+    """
+    spans_by_id = {(span.segment_id, span.span_id): span for span in spans}
+    # only some spans of a segment have references, and they may come after other spans of the segment or before
+    # the referenced span, so segments parents are solved before linking any span
+    segments_parents = {}
+    for span in spans:
+        if span.parent_segment_id and span.parent_segment_id != span.segment_id \
+                and span.segment_id not in segments_parents:
+            parent = spans_by_id.get((span.parent_segment_id, span.parent_span_id))
+            if parent:
+                segments_parents[span.segment_id] = parent
+    roots = []
+    for span in spans:
+        parent = segments_parents.get(span.segment_id)
+        (parent.children if parent else roots).append(span)
+    _simplify_spans(roots)
+    return roots
+
+
+def _has_missing_segments(roots: List[TraceSpan]) -> bool:
+    # roots referencing a parent segment of the same trace mean the parent segment was not found
+    return any(root.parent_segment_id and root.ref_trace_id in (None, root.trace_id) for root in roots)
+
+
+def _simplify_spans(roots: List[TraceSpan]):
+    # children are simplified before their parents, using a stack of (span, children_simplified) for the post-order
+    stack = [(span, False) for span in roots]
+    while stack:
+        span, children_simplified = stack.pop()
+        if not span.children:
+            continue
+        if not children_simplified:
+            stack.append((span, True))
+            stack.extend((child, False) for child in span.children)
+            continue
+        final_children = []
+        for child in span.children:
+            if child.type in _FLATTENED_SPAN_TYPES:
+                final_children.extend(child.children)
+            else:
+                final_children.append(child)
+        span.children = final_children
 
 
 class SkywalkingApi:
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, services_ttl: float = 60, traces_cache_size: int = 1000, traces_cache_ttl: float = 60,
+                 batch_window: float = 0, batch_max_fields: int = 100, metrics_chunk_size: int = 50,
+                 metrics_concurrency: int = 4,
+                 cache: Optional[CacheBackend] = None, topology_ttl: float = 60, topology_minutes: int = 10,
+                 topology_changes_size: int = 10):
         self._base_url = url
         self.services_url = f"{url}/General-Service/Services"
         transport = AIOHTTPTransport(url=url + "/graphql")
-        self._client = Client(transport=transport, fetch_schema_from_transport=True)
+        # queries are static and are validated by the server, so there is no need to validate them on each request
+        self._client = Client(transport=transport)
+        self._batcher = QueryBatcher(self._execute, batch_window, batch_max_fields)
+        self._batch_max_fields = batch_max_fields
+        self._cache = cache or InMemoryCacheBackend()
+        self._services_ttl = services_ttl
+        self._services_catalog = CachedValue(self._load_services_catalog, services_ttl)
+        # traces may still get new segments after found, so they are only kept for a short time
+        self._traces_spans: LruCache[str, List[TraceSpan]] = LruCache(traces_cache_size, traces_cache_ttl)
+        self._metrics_chunk_size = metrics_chunk_size
+        self._metrics_concurrency = metrics_concurrency
+        # the topology of the default time window is kept as a snapshot, refreshed after ttl, to serve repeated
+        # requests without querying the server and to track changes between snapshots
+        self.topology_minutes = topology_minutes
+        self._topology_snapshot = CachedValue(self._load_topology_snapshot, topology_ttl)
+        self._last_topology: Optional[Topology] = None
+        self._topology_changes: deque[TopologyChanges] = deque(maxlen=topology_changes_size)
 
     async def connect(self):
         await self._client.connect_async(reconnecting=True)
@@ -210,119 +358,166 @@ class SkywalkingApi:
         await self._client.close_async()
 
     async def find_services(self) -> List[Service]:
-        result = await self._query_by_name("list-services", {})
-        return [Service(**service) for service in result['services']]
+        catalog = await self.find_services_catalog()
+        return catalog.services
 
-    async def _query_by_name(self, query_name: str, context: Dict[str, Any]) -> dict:
-        return await self._query(self._solve_query(query_name, context))
+    async def find_services_catalog(self) -> ServicesCatalog:
+        return await self._services_catalog.get()
 
-    @staticmethod
-    def _solve_query(query_name: str, context: Dict[str, Any]) -> str:
-        return solve_template(f"graphql/{query_name}.gql", context)
+    async def _load_services_catalog(self) -> ServicesCatalog:
+        # services are shared through the cache backend, so only one worker queries them on each ttl period
+        cached = await self._cache.get("services")
+        if cached:
+            return ServicesCatalog([Service(**service) for service in json.loads(cached)])
+        result = await self._query("list-services")
+        await self._cache.set("services", json.dumps(result['services']), self._services_ttl)
+        return ServicesCatalog([Service(**service) for service in result['services']])
+
+    async def _query(self, query_name: str, variables: Optional[Dict[str, Any]] = None) -> dict:
+        return await self._batcher.query(queries[query_name], variables or {})
 
-    async def _query(self, query: str) -> dict:
-        return await self._client.session.execute(gql(query))
+    async def _execute(self, document: DocumentNode, variables: Dict[str, Any]) -> dict:
+        return await self._client.session.execute(document, variable_values=variables)
 
     async def find_services_summary_metrics(self, services: List[Service], time_range: TimeRange) \
             -> Dict[str, ServiceSummaryMetrics]:
+        ret = {}
+        async for chunk_metrics in self.iter_services_summary_metrics(services, time_range):
+            ret.update(chunk_metrics)
+        return {service.shortName: ret[service.shortName] for service in services if service.shortName in ret}
+
+    async def iter_services_summary_metrics(self, services: List[Service], time_range: TimeRange) \
+            -> AsyncIterator[Dict[str, ServiceSummaryMetrics]]:
         metrics = {
             "cpm": "avg(service_cpm)",
             "sla": "avg(service_sla)/100",
             "resp_time": "avg(service_resp_time)",
             "apdex": "avg(service_apdex)/10000",
         }
-        result = await self.find_services_metrics(services, metrics, time_range)
-        ret = {}
-        for service_name, service_metrics in result.items():
-            for metric_name, metric_value in service_metrics.items():
-                service_metrics = ret.get(service_name, ServiceSummaryMetrics())
-                service_metrics[metric_name] = metric_value[0].values[0].value
-                ret[service_name] = service_metrics
-        return ret
+        async for result in self.iter_services_metrics(services, metrics, time_range):
+            ret = {}
+            for service_name, service_metrics in result.items():
+                for metric_name, metric_value in service_metrics.items():
+                    service_metrics = ret.get(service_name, ServiceSummaryMetrics())
+                    values = metric_value[0].values if metric_value else []
+                    service_metrics[metric_name] = None if not len(values) or np.isnan(values[0]) \
+                        else values[0].item()
+                    ret[service_name] = service_metrics
+            yield ret
 
     async def find_services_metrics(self, services: List[Service], metrics: Dict[str, str], time_range: TimeRange) -> \
             Dict[str, Dict[str, List[ServiceMetric]]]:
-        query = self._build_services_metrics_query(services, metrics, time_range)
-        result = await self._query(query)
-        return self._parse_service_metrics(result)
-
-    def _build_services_metrics_query(
-            self, services: List[Service], metrics: Dict[str, str], time_range: TimeRange) -> str:
-        queries = []
-        for service in services:
-            for metric_name, expression in metrics.items():
-                query = self._solve_query("service-metric",
-                                          {"service": service, "metric_name": metric_name, "expression": expression,
-                                           "duration": time_range})
-                queries.append(query)
-        return f"""
-            query queryMetrics {{
-              {'\n'.join(queries)}
-            }}
-        """
-
-    def _parse_service_metrics(self, result: dict) -> Dict[str, Dict[str, List[ServiceMetric]]]:
+        found = {}
+        async for chunk_metrics in self.iter_services_metrics(services, metrics, time_range):
+            found.update(chunk_metrics)
+        return {service.shortName: found[service.shortName] for service in services if service.shortName in found}
+
+    async def iter_services_metrics(self, services: List[Service], metrics: Dict[str, str], time_range: TimeRange) \
+            -> AsyncIterator[Dict[str, Dict[str, List[ServiceMetric]]]]:
+        """Provides metrics of services, in services order, as soon as each chunk of services metrics is retrieved."""
+        # services are split in chunks to avoid huge queries which may time out, and failing chunks only cause
+        # missing data from their services
+        # each chunk is sent in one request, so it is also limited to the fields allowed in a batch
+        chunk_size = max(1, min(self._metrics_chunk_size, self._batch_max_fields // max(len(metrics), 1)))
+        chunks = [services[i:i + chunk_size] for i in range(0, len(services), chunk_size)]
+        semaphore = asyncio.Semaphore(self._metrics_concurrency)
+        tasks = [asyncio.create_task(self._find_services_metrics_chunk(chunk, metrics, time_range, semaphore))
+                 for chunk in chunks]
+        try:
+            # chunks run concurrently but are provided in services order (keeping the ones finished earlier until
+            # previous ones finish), so results are the same on each call
+            for task in tasks:
+                yield await task
+        finally:
+            # when the consumer is cancelled (or stops iterating) pending chunks are cancelled to avoid useless queries
+            for task in tasks:
+                task.cancel()
+
+    async def _find_services_metrics_chunk(
+            self, services: List[Service], metrics: Dict[str, str], time_range: TimeRange,
+            semaphore: asyncio.Semaphore) -> Dict[str, Dict[str, List[ServiceMetric]]]:
+        duration = time_range.to_gql_variable()
+        service_metrics = [(service, metric_name, expression) for service in services
+                           for metric_name, expression in metrics.items()]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                results = await self._batcher.query_all([
+                    (queries["service-metric"],
+                     {"expression": expression, "entity": service.to_gql_variable(), "duration": duration})
+                    for service, _, expression in service_metrics])
+            except Exception:
+                logger.exception(f"Problem retrieving metrics for services {', '.join(s.name for s in services)}")
+                metrics_registry.increment("skywalking.metrics_chunk_errors")
+                return {}
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                logger.info(f"Metrics chunk of {len(services)} services took {elapsed:.0f} ms")
+                metrics_registry.observe("skywalking.metrics_chunk_ms", elapsed)
         ret = {}
-        for expression_name, expression_result in result.items():
+        for (service, metric_name, _), result in zip(service_metrics, results):
+            expression_result = result['result']
             error = expression_result['error']
             if error:
-                logger.error(f"Error retrieving {expression_name}: {error}")
+                logger.error(f"Error retrieving {metric_name} for {service.name}: {error}")
                 continue
-            name_parts = expression_name.split('_', 1)
-            service_metrics = ret.setdefault(name_parts[0], {})
-            metric_results = service_metrics.setdefault(name_parts[1], [])
-            for metric_result in expression_result['results']:
-                metric_results.append(ServiceMetric.from_gql(metric_result))
+            ret.setdefault(service.shortName, {})[metric_name] = [
+                ServiceMetric.from_gql(metric_result) for metric_result in expression_result['results']]
         return ret
 
     async def find_services_topology(self, services: List[Service], time_range: TimeRange) -> Topology:
-        service_ids = _val_to_gql([service.id for service in services])
-        result = await self._query_by_name("services-topology", {"duration": time_range, "service_ids": service_ids})
+        result = await self._query("services-topology", {"duration": time_range.to_gql_variable(),
+                                                         "serviceIds": [service.id for service in services]})
         return Topology.from_graphql(result['topology'])
 
+    async def find_topology_snapshot(self) -> Topology:
+        """Gets the topology of services in the last topology_minutes, as of the last snapshot."""
+        return await self._topology_snapshot.get()
+
+    async def find_topology_changes(self) -> List[TopologyChanges]:
+        """Gets the most recent changes between topology snapshots, newest last."""
+        # an expired snapshot is refreshed before answering, so changes since the last snapshot are included
+        await self._topology_snapshot.get_fresh()
+        return list(self._topology_changes)
+
+    async def _load_topology_snapshot(self) -> Topology:
+        services = await self.find_services()
+        topology = await self.find_services_topology(services, TimeRange.from_last_minutes(self.topology_minutes))
+        if self._last_topology:
+            changes = topology.diff(self._last_topology)
+            if not changes.is_empty():
+                self._topology_changes.append(changes)
+        self._last_topology = topology
+        return topology
+
     def get_service_url(self, service: Service) -> str:
         layer = service.layers[0]
         return f"{self._base_url}/dashboard/{layer}/Service/{service.id}/{'Browser-App' if layer == 'BROWSER' else 'General-Service'}"
 
     async def find_alarms(self, time_range: TimeRange, limit: int) -> List[Alarm]:
-        result = await self._query_by_name("alarms", {"duration": time_range, "limit": limit})
+        result = await self._query("alarms", {"duration": time_range.to_gql_variable(),
+                                              "paging": {"pageNum": 1, "pageSize": limit}})
         return [Alarm.from_gql(alarm) for alarm in result['getAlarm']['msgs']]
 
     async def find_trace_spans(self, trace_id: str) -> List[TraceSpan]:
-        result = await self._query_by_name("trace", {"trace_id": _val_to_gql(trace_id)})
-        spans_by_id = {}
-        segments_parents = {}
-        root_spans = []
-        for span in result['trace']['spans']:
-            span = TraceSpan.from_gql(span)
-            spans_by_id[self._build_unique_span_id(span.segment_id, span.span_id)] = span
-            segment_parent = segments_parents.get(span.segment_id)
-            if not segment_parent and span.parent_segment_id:
-                segment_parent = spans_by_id.get(self._build_unique_span_id(span.parent_segment_id, span.parent_span_id))
-                if segment_parent:
-                    segments_parents[span.segment_id] = segment_parent
-            if segment_parent:
-                segment_parent.children.append(span)
-            else:
-                root_spans.append(span)
-        for span in root_spans:
-            self._simplify_span(span)
-        return root_spans
-
-    @staticmethod
-    def _build_unique_span_id(segment_id: str, span_id: int) -> str:
-        return f"{segment_id}-{span_id}"
+        ret = self._traces_spans.get(trace_id)
+        if ret is None:
+            ret = await self._query_trace_spans(trace_id)
+            # traces may not be yet available, or only partially, so we only cache the ones found with all their
+            # referenced segments
+            if ret and not _has_missing_segments(ret):
+                self._traces_spans.set(trace_id, ret)
+        return ret
 
-    def _simplify_span(self, span: TraceSpan):
-        final_children = []
-        for child in span.children:
-            self._simplify_span(child)
-            if child.type in [TraceSpanType.LOCAL, TraceSpanType.ENTRY]:
-                final_children += child.children
-            else:
-                final_children.append(child)
-        span.children = final_children
+    async def _query_trace_spans(self, trace_id: str) -> List[TraceSpan]:
+        result = await self._query("trace", {"traceId": trace_id})
+        return build_spans_tree([TraceSpan.from_gql(span) for span in result['trace']['spans']])
 
     async def find_service_by_name(self, service_name: str) -> Service:
-        result = await self._query_by_name("service-by-name", {"service_name": service_name})
-        return Service(**result['service']) if result else None
+        catalog = await self.find_services_catalog()
+        ret = catalog.find_by_name(service_name)
+        if ret:
+            return ret
+        # services from other layers (eg: browser apps) are not listed in the catalog
+        result = await self._query("service-by-name", {"serviceName": service_name})
+        return Service(**result['service']) if result['service'] else None
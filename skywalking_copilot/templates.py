@@ -2,16 +2,29 @@ import json
 import os
 from typing import Dict, Any
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template
 
 assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets')
-templates_repo = Environment(loader=FileSystemLoader(assets_path))
+# templates are not changed while running, so there is no need to check their files on each lookup. Compiled templates
+# are kept in a bytecode cache to avoid compiling them again on each worker start
+templates_repo = Environment(loader=FileSystemLoader(assets_path), auto_reload=False,
+                             bytecode_cache=FileSystemBytecodeCache())
 templates_repo.filters['json'] = json.dumps
 
 
+def _load_responses() -> Dict[str, Template]:
+    responses_path = os.path.join(assets_path, 'responses')
+    return {os.path.splitext(file_name)[0]: templates_repo.get_template(f"responses/{file_name}")
+            for file_name in os.listdir(responses_path) if file_name.endswith(".md")}
+
+
+# responses are rendered for every answer, so they are loaded only once and kept as compiled templates
+responses = _load_responses()
+
+
 def solve_response(name: str, ctx: Dict[str, Any]) -> str:
-    return solve_template(f"responses/{name}.md", ctx)
+    return responses[name].render(**ctx)
 
 
-def solve_template(file_name: str, context: Dict[str, Any]) -> str:
-    return templates_repo.get_template(file_name).render(**context)
+def solve_response_macro(name: str, macro: str, *args: Any) -> str:
+    return getattr(responses[name].module, macro)(*args)
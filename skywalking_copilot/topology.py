@@ -0,0 +1,90 @@
+import re
+from collections import deque
+from typing import Collection, Dict, Iterable, List, Tuple
+
+from skywalking_copilot.skywalking import Topology, TopologyNode
+
+COLLAPSED_NODE_ID = "collapsed"
+_NON_WORD_PATTERN = re.compile(r"\W")
+
+
+class TopologyGraph:
+    """
+    Services topology indexed by node, with deduplicated edges, to extract and prune the parts of big meshes worth
+    showing to the user.
+
+    Adjacencies are kept in dicts (instead of sets) to preserve the order provided by the server, so rendered diagrams
+    are stable between calls.
+    """
+
+    def __init__(self, nodes: Iterable[TopologyNode], edges: Iterable[Tuple[str, str]]):
+        self.nodes: Dict[str, TopologyNode] = {node.id: node for node in nodes}
+        self._targets: Dict[str, Dict[str, None]] = {node_id: {} for node_id in self.nodes}
+        self._sources: Dict[str, Dict[str, None]] = {node_id: {} for node_id in self.nodes}
+        for source, target in edges:
+            # edges from or to ignored nodes (eg: users) are discarded
+            if source in self.nodes and target in self.nodes:
+                self._targets[source][target] = None
+                self._sources[target][source] = None
+
+    @staticmethod
+    def from_topology(topology: Topology, ignored_types: Collection[str] = ("USER",)) -> 'TopologyGraph':
+        return TopologyGraph([node for node in topology.nodes if node.type not in ignored_types],
+                             [(edge.source, edge.target) for edge in topology.edges])
+
+    @property
+    def edges(self) -> List[Tuple[str, str]]:
+        return [(source, target) for source, targets in self._targets.items() for target in targets]
+
+    def degree(self, node_id: str) -> int:
+        return len(self._targets[node_id]) + len(self._sources[node_id])
+
+    def neighbourhood(self, node_ids: Collection[str], hops: int) -> 'TopologyGraph':
+        """Gets the subgraph of nodes reachable within the given hops from given nodes, following calls both ways."""
+        distances = {node_id: 0 for node_id in node_ids if node_id in self.nodes}
+        queue = deque(distances)
+        while queue:
+            node_id = queue.popleft()
+            distance = distances[node_id]
+            if distance == hops:
+                continue
+            for neighbour in (*self._targets[node_id], *self._sources[node_id]):
+                if neighbour not in distances:
+                    distances[neighbour] = distance + 1
+                    queue.append(neighbour)
+        return self.subgraph(distances)
+
+    def subgraph(self, node_ids: Collection[str]) -> 'TopologyGraph':
+        return TopologyGraph([node for node_id, node in self.nodes.items() if node_id in node_ids],
+                             [(source, target) for source, target in self.edges
+                              if source in node_ids and target in node_ids])
+
+    def limit_nodes(self, max_nodes: int, kept_ids: Collection[str] = ()) -> 'TopologyGraph':
+        """
+        Keeps at most max_nodes nodes, preferring given kept_ids and then the most connected nodes, and collapses the
+        rest into one node which keeps the calls from and to the collapsed nodes.
+        """
+        if len(self.nodes) <= max_nodes:
+            return self
+        ranked = sorted(self.nodes, key=lambda node_id: (node_id not in kept_ids, -self.degree(node_id)))
+        kept = set(ranked[:max_nodes - 1])
+        collapsed_count = len(self.nodes) - len(kept)
+        nodes = [node for node_id, node in self.nodes.items() if node_id in kept]
+        nodes.append(TopologyNode(id=COLLAPSED_NODE_ID, name=f"{collapsed_count} other services", type=None))
+        edges = {}
+        for source, target in self.edges:
+            source = source if source in kept else COLLAPSED_NODE_ID
+            target = target if target in kept else COLLAPSED_NODE_ID
+            if source != COLLAPSED_NODE_ID or target != COLLAPSED_NODE_ID:
+                edges[(source, target)] = None
+        return TopologyGraph(nodes, edges)
+
+    def diagram_ids(self) -> Dict[str, str]:
+        """Gets identifiers for nodes which are valid in PlantUML diagrams, using the node name when possible."""
+        ret = {}
+        for index, (node_id, node) in enumerate(self.nodes.items()):
+            diagram_id = node.name
+            if _NON_WORD_PATTERN.search(diagram_id):
+                diagram_id = f"{node.type.lower() if node.type else 'node'}{index}"
+            ret[node_id] = diagram_id
+        return ret
@@ -0,0 +1,135 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from skywalking_copilot.skywalking import TraceSpan
+
+MAX_SPAN_NAME_LENGTH = 200
+
+
+def build_spans_context(spans: List[TraceSpan]) -> List[Dict]:
+    ret = []
+    # spans are traversed with an explicit stack instead of recursion to support deep traces, and pushed in reverse
+    # order so they are popped in order
+    stack = [(span, "", idx == len(spans) - 1) for idx, span in reversed(list(enumerate(spans)))]
+    while stack:
+        span, prefix, is_last = stack.pop()
+        ret.append({
+            'prefix': prefix + ("└─ " if is_last else "├─ "),
+            'name': _build_span_name(span),
+            'duration': span.end_time - span.start_time
+        })
+        children = span.children
+        children_prefix = prefix + ("    " if is_last else "│   ")
+        stack.extend((children[idx], children_prefix, idx == len(children) - 1)
+                     for idx in range(len(children) - 1, -1, -1))
+    return ret
+
+
+def _build_span_name(span: TraceSpan) -> str:
+    if span.layer == 'Http':
+        return f"{span.tags.get('http.method', 'GET')} {span.tags.get('url') or span.tags.get('http.url')
+                                                        or span.endpoint}"
+    elif span.layer == 'Database':
+        return f"@{span.peer} {span.tags.get('db.statement') or span.endpoint}"
+    elif span.layer == 'MQ':
+        return f"@{span.peer} {span.endpoint}"
+    return span.endpoint
+
+
+def count_spans(spans: List[TraceSpan]) -> int:
+    return sum(1 for _ in _iter_spans(spans))
+
+
+def _iter_spans(spans: List[TraceSpan]) -> Iterator[Tuple[Optional[TraceSpan], TraceSpan]]:
+    """Iterates all spans of the given trees with their parents (None for roots), in no particular order."""
+    stack: List[Tuple[Optional[TraceSpan], TraceSpan]] = [(None, span) for span in spans]
+    while stack:
+        parent, span = stack.pop()
+        yield parent, span
+        stack.extend((span, child) for child in span.children)
+
+
+def summarize_spans(spans: List[TraceSpan], top: int) -> Dict:
+    """
+    Builds a summary of the given trees whose size only depends on top: the top spans contributing to the critical
+    path (in time order), and the top groups of repeated sibling spans (eg: N+1 queries) by self time.
+    """
+    groups = {}
+    spans_count = 0
+    errors_count = 0
+    for parent, span in _iter_spans(spans):
+        spans_count += 1
+        errors_count += span.is_error
+        name = _build_span_name(span)
+        group = groups.setdefault((id(parent), name), {'name': name, 'count': 0, 'duration': 0, 'self_time': 0})
+        group['count'] += 1
+        group['duration'] += span.end_time - span.start_time
+        group['self_time'] += _self_time(span)
+    critical_path = _find_critical_path(spans)
+    top_critical = sorted(sorted(critical_path, key=lambda c: c[1], reverse=True)[:top],
+                          key=lambda c: c[0].start_time)
+    start = min(span.start_time for span in spans)
+    return {
+        'spans_count': spans_count,
+        'errors_count': errors_count,
+        'duration': max(span.end_time for span in spans) - start,
+        'critical_path': [{
+            'offset': span.start_time - start,
+            'name': _truncate_name(_build_span_name(span)),
+            'duration': span.end_time - span.start_time,
+            'critical_time': critical_time,
+        } for span, critical_time in top_critical],
+        'omitted_critical_spans': len(critical_path) - len(top_critical),
+        'omitted_critical_time': sum(c[1] for c in critical_path) - sum(c[1] for c in top_critical),
+        'top_spans': [{**group, 'name': _truncate_name(group['name'])}
+                      for group in sorted(groups.values(), key=lambda g: g['self_time'], reverse=True)[:top]],
+    }
+
+
+def _self_time(span: TraceSpan) -> int:
+    # children may run concurrently, so the time covered by them is computed by merging their intervals
+    covered = 0
+    cursor = span.start_time
+    for start, end in sorted((child.start_time, child.end_time) for child in span.children):
+        start = max(start, cursor)
+        end = min(end, span.end_time)
+        if end > start:
+            covered += end - start
+            cursor = end
+    return span.end_time - span.start_time - covered
+
+
+def _find_critical_path(spans: List[TraceSpan]) -> List[Tuple[TraceSpan, int]]:
+    """
+    Finds the spans in the critical path of the given trees, with the time each one contributes to it.
+
+    Starting from the end of the trace, the critical path goes through the last finishing child of each span, and then
+    through children finishing before that child started. Remaining time is attributed to the span itself.
+    """
+    critical_times: Dict[int, Tuple[TraceSpan, int]] = {}
+    end = max(span.end_time for span in spans)
+    # items are either spans to visit until an end time, or time attributed to a span (None for time between roots).
+    # Each visit pushes items in reverse time order, so they are popped in time order.
+    stack: List[Tuple[bool, Optional[TraceSpan], List[TraceSpan], int, int]] = [
+        (True, None, spans, min(span.start_time for span in spans), end)]
+    while stack:
+        is_visit, span, children, start, end = stack.pop()
+        if not is_visit:
+            if span and end > start:
+                current = critical_times.get(id(span))
+                critical_times[id(span)] = (span, (current[1] if current else 0) + end - start)
+            continue
+        cursor = end
+        for child in sorted(children, key=lambda c: c.end_time, reverse=True):
+            if child.start_time >= cursor or child.end_time <= start:
+                continue
+            child_end = min(child.end_time, cursor)
+            stack.append((False, span, [], child_end, cursor))
+            # children starting before their parent (eg: due to clock skew) only count within the parent window
+            stack.append((True, child, child.children, max(child.start_time, start), child_end))
+            cursor = max(child.start_time, start)
+        stack.append((False, span, [], start, cursor))
+    return list(critical_times.values())
+
+
+def _truncate_name(name: str) -> str:
+    return name if len(name) <= MAX_SPAN_NAME_LENGTH else name[:MAX_SPAN_NAME_LENGTH - 1] + "…"
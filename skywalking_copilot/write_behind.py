@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from skywalking_copilot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+class WriteBehindQueue(Generic[T]):
+    """
+    Queues items to be written in the background, so callers don't wait for (nor hold connections during) writes.
+
+    Items queued while a batch is being written are written together in the next batch, up to batch_size items.
+    Items are queued with a key (eg: a session id), so readers may wait for pending writes of a key before reading.
+    Failed batches are logged and discarded.
+    """
+
+    def __init__(self, name: str, write: Callable[[List[T]], Awaitable[None]], batch_size: int = 100,
+                 max_pending: int = 10000):
+        self._name = name
+        self._write = write
+        self._batch_size = batch_size
+        self._queue: asyncio.Queue[Tuple[Hashable, T, asyncio.Future]] = asyncio.Queue(max_pending)
+        self._last_writes: Dict[Hashable, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Waits for all queued items to be written, and stops the background writer."""
+        if not self._task:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def put(self, key: Hashable, item: T):
+        future = asyncio.get_running_loop().create_future()
+        self._last_writes[key] = future
+        # waits when max_pending items are queued, to avoid growing memory when writes can't keep up
+        await self._queue.put((key, item, future))
+
+    async def wait_written(self, key: Hashable):
+        """Waits until items queued for the given key, before this call, are written (or discarded)."""
+        future = self._last_writes.get(key)
+        if future:
+            await asyncio.shield(future)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch: List[Tuple[Hashable, T, asyncio.Future]]):
+        metrics.observe(f"write_behind.{self._name}.batch_size", len(batch))
+        try:
+            await self._write([item for _, item, _ in batch])
+        except Exception:
+            logger.exception(f"Problem writing {len(batch)} {self._name}, discarding them")
+            metrics.increment(f"write_behind.{self._name}.discarded", len(batch))
+        for key, _, future in batch:
+            future.set_result(None)
+            if self._last_writes.get(key) is future:
+                del self._last_writes[key]
+            self._queue.task_done()